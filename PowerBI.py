@@ -1,13 +1,25 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import io
 import json
+import re
+from urllib.parse import urlencode
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-from azure.mgmt.monitor import MonitorManagementClient
-from azure.mgmt.resource import ResourceManagementClient
-import random
+
+# orjson parses large ARM/Cost payloads several times faster; stdlib json is the fallback
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Page Configuration
 st.set_page_config(
@@ -53,15 +65,74 @@ CARBON_FACTORS = {
     "embedding": 0.0001        # kWh per 1k tokens (lighter)
 }
 
+# Model name keyword -> energy class (anything unmatched is standard text)
+MODEL_TYPE_RE = re.compile(r'(dall|o1|reasoning|embedding)')
+MODEL_TYPE_MAP = {"dall": "image", "o1": "reasoning", "reasoning": "reasoning", "embedding": "embedding"}
+
 # Tree Absorption: ~21kg CO2 per year = ~57.5g per day
 GRAMS_CO2_PER_TREE_DAY = 57.5
 
+ARM_SCOPE = "https://management.azure.com/.default"
+
+# Azure fetches are reused across reruns for this long (seconds)
+AZURE_CACHE_TTL = 300
+
+# ARM $batch accepts up to 20 sub-requests per POST
+ARM_BATCH_URL = "https://management.azure.com/batch?api-version=2020-06-01"
+ARM_BATCH_SIZE = 20
+# Per-request timeout and how long an accepted (202) batch may stay pending
+ARM_TIMEOUT = 30
+ARM_BATCH_POLL_DEADLINE = 120
+# Re-submissions for sub-requests answered with 429/5xx
+ARM_BATCH_RETRIES = 3
+
+class TokenCache:
+    """Reuses bearer tokens per (credential, scope) until 60s before they expire."""
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, credential, scope=ARM_SCOPE):
+        key = (id(credential), scope)
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - time.time() <= 60:
+                token = credential.get_token(scope)
+                self._tokens[key] = token
+            return token
+
+    def wrap(self, credential):
+        """Credential facade so SDK clients draw their tokens from this cache."""
+        cache = self
+        class _Cached:
+            def get_token(self, *scopes, **kwargs):
+                return cache.get(credential, scopes[0] if scopes else ARM_SCOPE)
+        return _Cached()
+
+@st.cache_resource
+def get_token_cache():
+    return TokenCache()
+
+@st.cache_resource
+def get_http_session():
+    """Shared keep-alive session so parallel ARM calls reuse pooled connections."""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods={"GET", "POST"})
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+SESSION = get_http_session()
+
 @st.cache_resource
 def get_azure_credentials():
     """Authenticates using Default or Interactive credentials."""
+    # Azure SDK imports are deferred so Demo mode never pays for them
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
     try:
         credential = DefaultAzureCredential()
-        credential.get_token("https://management.azure.com/.default")
+        get_token_cache().get(credential)
         return credential
     except Exception as e:
         print(f"DefaultAuth failed: {e}")
@@ -71,22 +142,22 @@ def get_azure_credentials():
             st.error(f"Authentication failed: {e2}")
             return None
 
-def get_deployments(credential, subscription_id, resource_group, account_name):
+def get_deployments(credential, token_cache, subscription_id, resource_group, account_name):
     """
     Fetches the list of deployments (models) for a specific OpenAI account.
     """
     deployments = []
     try:
-        token = credential.get_token("https://management.azure.com/.default").token
+        token = token_cache.get(credential).token
         headers = {"Authorization": f"Bearer {token}"}
         
         api_version = "2023-05-01"
         url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{account_name}/deployments?api-version={api_version}"
         
-        response = requests.get(url, headers=headers)
+        response = SESSION.get(url, headers=headers, timeout=ARM_TIMEOUT)
         
         if response.status_code == 200:
-            items = response.json().get('value', [])
+            items = json_loads(response.content).get('value', [])
             for item in items:
                 props = item.get('properties', {})
                 model_info = props.get('model', {})
@@ -105,16 +176,17 @@ def get_deployments(credential, subscription_id, resource_group, account_name):
         
     return deployments
 
-def fetch_actual_costs(credential, subscription_id, resource_ids, days=7):
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def fetch_actual_costs(_credential, _token_cache, subscription_id, resource_ids, days=7):
     """
     Fetches REAL billing data from Azure Cost Management API.
     Note: Requires 'Cost Management Reader' permission.
     """
-    cost_data = []
+    dates, resids, costs, currs = [], [], [], []
     error_msg = None
     
     try:
-        token = credential.get_token("https://management.azure.com/.default").token
+        token = _token_cache.get(_credential).token
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
@@ -155,35 +227,58 @@ def fetch_actual_costs(credential, subscription_id, resource_ids, days=7):
             }
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            result = response.json()
-            # Rows: [Cost, Currency, ResourceId, ServiceName, Date]
-            rows = result.get('properties', {}).get('rows', [])
-            for r in rows:
-                cost_data.append({
-                    "Date": r[4], # Date is usually index 4 or 3 depending on API version
-                    "ResourceId": r[2],
-                    "ActualCost": r[0],
-                    "Currency": r[1]
-                })
-        elif response.status_code == 403:
-            error_msg = "⚠️ Permission Denied: Your account does not have 'Cost Management Reader' access."
-        else:
-            error_msg = f"Cost API Error: {response.status_code} - {response.text}"
+        # Results are paged (~1000 rows); keep following nextLink until exhausted
+        while url:
+            response = SESSION.post(url, headers=headers, json=payload, timeout=ARM_TIMEOUT)
+            
+            if response.status_code == 200:
+                result = json_loads(response.content)
+                # Rows: [Cost, Currency, ResourceId, ServiceName, Date]
+                rows = result.get('properties', {}).get('rows', [])
+                for r in rows:
+                    dates.append(r[4]) # Date is usually index 4 or 3 depending on API version
+                    resids.append(r[2])
+                    costs.append(r[0])
+                    currs.append(r[1])
+                url = result.get('properties', {}).get('nextLink') or result.get('nextLink')
+            elif response.status_code == 403:
+                error_msg = "⚠️ Permission Denied: Your account does not have 'Cost Management Reader' access."
+                break
+            else:
+                error_msg = f"Cost API Error: {response.status_code} - {response.text}"
+                break
             
     except Exception as e:
         error_msg = f"Failed to fetch costs: {str(e)}"
+
+    if not costs:
+        return pd.DataFrame(), error_msg
+
+    # Parse dates once at ingest: UsageDate is normally an int like 20240131,
+    # anything else (ISO strings) goes through the generic parser
+    date_col = pd.Series(dates, dtype=object)
+    as_num = pd.to_numeric(date_col, errors='coerce')
+    parsed = pd.to_datetime(as_num.astype('Int64').astype(str), format='%Y%m%d', errors='coerce', cache=True)
+    missing = parsed.isna()
+    if missing.any():
+        parsed[missing] = pd.to_datetime(date_col[missing], errors='coerce')
         
-    return pd.DataFrame(cost_data), error_msg
+    return pd.DataFrame({
+        "Date": parsed,
+        "ResourceId": resids,
+        "ActualCost": pd.Series(costs, dtype='float32'),
+        "Currency": currs
+    }), error_msg
 
-def discover_resources_and_deployments(credential, subscription_id, resource_group=None, hub_name=None):
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def discover_resources_and_deployments(_credential, _token_cache, subscription_id, resource_group=None, hub_name=None):
     """
     Finds OpenAI accounts, then drills down to find Deployments (Models).
     """
+    from azure.mgmt.resource import ResourceManagementClient
+
     logs = []
-    resource_client = ResourceManagementClient(credential, subscription_id)
+    resource_client = ResourceManagementClient(_token_cache.wrap(_credential), subscription_id)
     found_accounts_list = []
     
     try:
@@ -211,12 +306,23 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
         logs.append(f"Error scanning resources: {e}")
 
     final_inventory = []
+    deployments_by_id = {}
     if found_accounts_list:
         pbar = st.progress(0)
+        # Deployment lookups are independent ARM GETs, so fan them out
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            futures = {
+                ex.submit(get_deployments, _credential, _token_cache, subscription_id, a['group'], a['name']): a
+                for a in found_accounts_list
+            }
+            for i, fut in enumerate(as_completed(futures)):
+                deployments_by_id[futures[fut]['id']] = fut.result()
+                pbar.progress((i + 1) / len(found_accounts_list))
+        pbar.empty()
         
-    for i, acct in enumerate(found_accounts_list):
+    for acct in found_accounts_list:
         logs.append(f"Inspecting account: {acct['name']}")
-        depts = get_deployments(credential, subscription_id, acct['group'], acct['name'])
+        depts = deployments_by_id[acct['id']]
         
         if not depts:
             final_inventory.append({
@@ -227,11 +333,8 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
             })
         else:
             for d in depts:
-                m_name = d['model_name'].lower()
-                if "dall" in m_name: m_type = "image"
-                elif "o1" in m_name or "reasoning" in m_name: m_type = "reasoning"
-                elif "embedding" in m_name: m_type = "embedding"
-                else: m_type = "text"
+                match = MODEL_TYPE_RE.search(d['model_name'].lower())
+                m_type = MODEL_TYPE_MAP[match.group(1)] if match else "text"
 
                 final_inventory.append({
                     **acct,
@@ -239,77 +342,148 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
                     "model_name": d['model_name'],
                     "type": m_type
                 })
-        
-        if found_accounts_list:
-            pbar.progress((i + 1) / len(found_accounts_list))
-            
-    if found_accounts_list:
-        pbar.empty()
                 
     return final_inventory, logs
 
-def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
-    client = MonitorManagementClient(credential, subscription_id)
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def fetch_detailed_metrics(_credential, _token_cache, subscription_id, inventory_list, days=7):
     metric_names = "ProcessedPromptTokens,GeneratedTokens,GeneratedImages"
     endtime = datetime.utcnow()
     starttime = endtime - timedelta(days=days)
     timespan = f"{starttime.isoformat()}/{endtime.isoformat()}"
 
-    data_rows = []
+    token = _token_cache.get(_credential).token
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    query = urlencode({
+        "timespan": timespan,
+        "interval": "PT1H",
+        "metricnames": metric_names,
+        "aggregation": "Total",
+        "api-version": "2018-01-01"
+    })
+
     errors = []
-    grouped_inventory = {}
-    for item in inventory_list:
-        if item['id'] not in grouped_inventory: grouped_inventory[item['id']] = []
-        grouped_inventory[item['id']].append(item)
+    # One sub-request per (account, deployment), sent to ARM in $batch groups
+    tasks = [(item['id'], item) for item in inventory_list]
 
-    progress_bar = st.progress(0)
-    total_steps = len(grouped_inventory)
-    current_step = 0
+    def metrics_url(account_id, dept):
+        dept_name = dept['deployment_name']
+        url = f"{account_id}/providers/Microsoft.Insights/metrics?{query}"
+        if dept_name != "All Models (Aggregated)":
+            url += "&" + urlencode({"$filter": f"ModelDeploymentName eq '{dept_name}'"})
+        return url
 
-    for account_id, deployments in grouped_inventory.items():
+    def parse(content):
+        # Sum points sharing (timestamp, metric) here so each deployment yields one row per bin;
+        # deployment fields are filled in once per task
+        totals = defaultdict(float)
+        for item in content.get('value', []):
+            metric_name = item['name']['value']
+            for timeseries in item.get('timeseries', []):
+                for data in timeseries.get('data', []):
+                    total = data.get('total')
+                    if total and total > 0:
+                        totals[(data['timeStamp'], metric_name)] += total
+        ts = [k[0] for k in totals]
+        metrics = [k[1] for k in totals]
+        return ts, metrics, list(totals.values())
+
+    def retry_after(headers, default):
         try:
-            for dept in deployments:
-                dept_name = dept['deployment_name']
-                is_agg = dept_name == "All Models (Aggregated)"
-                odata_filter = f"ModelDeploymentName eq '{dept_name}'" if not is_agg else None
-                
-                metrics_data = client.metrics.list(
-                    resource_uri=account_id,
-                    timespan=timespan,
-                    interval="PT1H",
-                    metricnames=metric_names,
-                    aggregation="Total",
-                    filter=odata_filter 
-                )
-                
-                for item in metrics_data.value:
-                    metric_name = item.name.value
-                    for timeseries in item.timeseries:
-                        for data in timeseries.data:
-                            if data.total and data.total > 0:
-                                data_rows.append({
-                                    "TimeStamp": data.time_stamp,
-                                    "Account": dept['name'],
-                                    "ResourceId": account_id,
-                                    "Deployment": dept_name,
-                                    "Model": dept['model_name'],
-                                    "Type": dept['type'],
-                                    "Metric": metric_name,
-                                    "Value": data.total
-                                })
-        except Exception as e:
-            if "BadRequest" not in str(e): errors.append(f"Error {account_id.split('/')[-1]}: {str(e)}")
-        
-        current_step += 1
-        progress_bar.progress(current_step / total_steps)
-        
+            return min(float((headers or {}).get('Retry-After', default)), 60)
+        except (TypeError, ValueError):
+            return default
+
+    def send_batch(sub_requests):
+        response = SESSION.post(ARM_BATCH_URL, headers=headers, json={"requests": sub_requests}, timeout=ARM_TIMEOUT)
+        # ARM may accept the batch asynchronously; poll the Location until it completes or the deadline passes
+        deadline = time.monotonic() + ARM_BATCH_POLL_DEADLINE
+        while response.status_code == 202 and 'Location' in response.headers:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"batch still pending after {ARM_BATCH_POLL_DEADLINE}s")
+            time.sleep(retry_after(response.headers, 1))
+            response = SESSION.get(response.headers['Location'], headers=headers, timeout=ARM_TIMEOUT)
+        response.raise_for_status()
+        return json_loads(response.content).get('responses', [])
+
+    def fetch_batch(start):
+        chunk = tasks[start:start + ARM_BATCH_SIZE]
+        pending = {
+            str(start + n): {"name": str(start + n), "httpMethod": "GET", "url": metrics_url(account_id, dept)}
+            for n, (account_id, dept) in enumerate(chunk)
+        }
+        # The outer POST succeeds even when sub-requests are throttled, so the session's Retry
+        # never sees them; re-submit 429/5xx sub-requests after their Retry-After
+        finished = []
+        for attempt in range(ARM_BATCH_RETRIES + 1):
+            wait = 0
+            retry = []
+            for resp in send_batch(list(pending.values())):
+                code = resp.get('httpStatusCode') or 0
+                if (code == 429 or code >= 500) and attempt < ARM_BATCH_RETRIES:
+                    retry.append(resp['name'])
+                    wait = max(wait, retry_after(resp.get('headers'), 2 ** attempt))
+                else:
+                    finished.append(resp)
+            pending = {name: pending[name] for name in retry}
+            if not pending:
+                break
+            time.sleep(wait)
+        return finished
+
+    progress_bar = st.progress(0)
+    results = [([], [], []) for _ in tasks]
+    starts = list(range(0, len(tasks), ARM_BATCH_SIZE))
+    if starts:
+        with ThreadPoolExecutor(max_workers=min(16, len(starts))) as ex:
+            futures = {ex.submit(fetch_batch, start): start for start in starts}
+            for done, fut in enumerate(as_completed(futures), start=1):
+                try:
+                    responses = fut.result()
+                except Exception as e:
+                    start = futures[fut]
+                    errors.append(f"Batch error ({len(tasks[start:start + ARM_BATCH_SIZE])} deployments): {str(e)}")
+                    responses = []
+                for resp in responses:
+                    i = int(resp['name'])
+                    content = resp.get('content') or {}
+                    if resp.get('httpStatusCode') == 200:
+                        results[i] = parse(content)
+                    else:
+                        err = content.get('error', {})
+                        if err.get('code') != "BadRequest":
+                            errors.append(f"Error {tasks[i][0].split('/')[-1]}: {resp.get('httpStatusCode')} {err.get('message', '')}")
+                progress_bar.progress(done / len(starts))
+
+    # Per-task columns are kept separate and joined once, in inventory order
+    cols = {k: [] for k in ("TimeStamp", "Account", "ResourceId", "Deployment", "Model", "Type", "Metric", "Value")}
+    for (account_id, dept), (ts, metrics, values) in zip(tasks, results):
+        n = len(ts)
+        cols["TimeStamp"].extend(ts)
+        cols["Account"].extend([dept['name']] * n)
+        cols["ResourceId"].extend([account_id] * n)
+        cols["Deployment"].extend([dept['deployment_name']] * n)
+        cols["Model"].extend([dept['model_name']] * n)
+        cols["Type"].extend([dept['type']] * n)
+        cols["Metric"].extend(metrics)
+        cols["Value"].extend(values)
+
     progress_bar.empty()
-    return pd.DataFrame(data_rows), errors
+    df = pd.DataFrame(cols)
+    df['TimeStamp'] = pd.to_datetime(df['TimeStamp'], utc=True)
+    df = df.astype({
+        'Value': 'float32', 'Account': 'category', 'Deployment': 'category',
+        'Model': 'category', 'Type': 'category', 'Metric': 'category'
+    })
+    return df, errors
 
 def generate_demo_data_detailed(days=7):
     # Generates fake usage AND fake cost data for demo
+    rng = np.random.default_rng()
     dates = pd.date_range(end=datetime.now(), periods=days*24, freq='H')
-    data = []
+    n = len(dates)
+    busy = (dates.hour >= 9) & (dates.hour <= 17)
+    hour_mod = np.where(busy, 10, 1)
     
     models = [
         {"name": "gpt-4", "type": "text", "dept": "gpt-4-deployment"},
@@ -317,54 +491,40 @@ def generate_demo_data_detailed(days=7):
         {"name": "dall-e-3", "type": "image", "dept": "img-gen"}
     ]
     
-    for date in dates:
-        hour_mod = 10 if 9 <= date.hour <= 17 else 1
-        for m in models:
-            if m['type'] == 'image':
-                val = int(random.random() * 5 * hour_mod) if hour_mod > 1 else 0
-                if val > 0:
-                    data.append({
-                        "TimeStamp": date, 
-                        "Model": m['name'], 
-                        "Type": "image", 
-                        "Metric": "GeneratedImages", 
-                        "Value": val, 
-                        "Deployment": m['dept'], 
-                        "ResourceId": "demo-id",
-                        "Account": "Demo Account" # Added missing field
-                    })
-            else:
-                prompts = int(random.gauss(500, 100) * hour_mod)
-                gens = int(random.gauss(200, 50) * hour_mod)
-                if prompts > 0:
-                    data.append({
-                        "TimeStamp": date, 
-                        "Model": m['name'], 
-                        "Type": m['type'], 
-                        "Metric": "ProcessedPromptTokens", 
-                        "Value": prompts, 
-                        "Deployment": m['dept'], 
-                        "ResourceId": "demo-id",
-                        "Account": "Demo Account" # Added missing field
-                    })
-                    data.append({
-                        "TimeStamp": date, 
-                        "Model": m['name'], 
-                        "Type": m['type'], 
-                        "Metric": "GeneratedTokens", 
-                        "Value": gens, 
-                        "Deployment": m['dept'], 
-                        "ResourceId": "demo-id",
-                        "Account": "Demo Account" # Added missing field
-                    })
+    # Draw each model's whole series at once and collect columns, not row dicts
+    cols = {"TimeStamp": [], "Model": [], "Type": [], "Metric": [], "Value": [], "Deployment": []}
+    def add(m, metric, ts, values):
+        cols["TimeStamp"].append(ts)
+        cols["Value"].append(values)
+        for key, val in (("Model", m['name']), ("Type", m['type']), ("Metric", metric), ("Deployment", m['dept'])):
+            cols[key].append(np.full(len(values), val, dtype=object))
+    
+    for m in models:
+        if m['type'] == 'image':
+            vals = np.where(busy, (rng.random(n) * 5 * hour_mod).astype(int), 0)
+            keep = vals > 0
+            add(m, "GeneratedImages", dates[keep], vals[keep])
+        else:
+            prompts = (rng.normal(500, 100, n) * hour_mod).astype(int)
+            gens = (rng.normal(200, 50, n) * hour_mod).astype(int)
+            keep = prompts > 0
+            add(m, "ProcessedPromptTokens", dates[keep], prompts[keep])
+            add(m, "GeneratedTokens", dates[keep], gens[keep])
+    
+    df = pd.DataFrame({k: np.concatenate(v) for k, v in cols.items()})
+    df["ResourceId"] = "demo-id"
+    df["Account"] = "Demo Account"
     
     # Fake Cost Data
-    cost_data = []
-    unique_days = sorted(list(set([d.date() for d in dates])))
-    for d in unique_days:
-        cost_data.append({"Date": str(d), "ActualCost": random.uniform(5, 50), "Currency": "USD", "ResourceId": "demo-id"})
+    unique_days = pd.Index(dates.date).unique()
+    df_cost = pd.DataFrame({
+        "Date": pd.to_datetime(unique_days),
+        "ActualCost": rng.uniform(5, 50, len(unique_days)),
+        "Currency": "USD",
+        "ResourceId": "demo-id"
+    })
         
-    return pd.DataFrame(data), pd.DataFrame(cost_data)
+    return df, df_cost
 
 # --- UI LAYOUT ---
 
@@ -396,11 +556,17 @@ with st.sidebar:
         fetch_btn = st.button("Fetch Data")
         show_debug = False
     else:
-        fetch_btn = True
+        # Demo data is generated once per session, not on every widget change
+        fetch_btn = st.session_state.get('pbi_data', {}).get('mode') != "Demo Data"
         days_to_fetch = 7
         sub_id = ""
         show_debug = False
 
+    # Cached Azure results live for AZURE_CACHE_TTL; this forces a fresh pull
+    if mode != "Demo Data" and st.button("🔄 Refresh", help="Clear cached Azure results and fetch again"):
+        st.cache_data.clear()
+        fetch_btn = True
+
 if fetch_btn:
     df_raw = pd.DataFrame()
     df_cost = pd.DataFrame()
@@ -418,20 +584,20 @@ if fetch_btn:
             credential = get_azure_credentials()
             if credential:
                 with st.spinner("🔍 Scanning for Accounts & Deployments..."):
-                    inventory, debug_logs = discover_resources_and_deployments(credential, sub_id, rg_name if 'rg_name' in locals() and rg_name else None)
+                    inventory, debug_logs = discover_resources_and_deployments(credential, get_token_cache(), sub_id, rg_name if 'rg_name' in locals() and rg_name else None)
                 
                 if inventory:
                     st.success(f"✅ Found {len(inventory)} deployments.")
                     
                     # 1. Fetch Metrics
                     with st.spinner("📊 Fetching usage metrics..."):
-                        df_raw, errors = fetch_detailed_metrics(credential, sub_id, inventory, days_to_fetch)
+                        df_raw, errors = fetch_detailed_metrics(credential, get_token_cache(), sub_id, inventory, days_to_fetch)
                     
                     # 2. Fetch Costs
                     with st.spinner("💰 Fetching real billing data..."):
                         # Extract unique resource IDs to query cost
                         unique_res_ids = list(set([item['id'] for item in inventory]))
-                        df_cost, cost_error = fetch_actual_costs(credential, sub_id, unique_res_ids, days_to_fetch)
+                        df_cost, cost_error = fetch_actual_costs(credential, get_token_cache(), sub_id, unique_res_ids, days_to_fetch)
                 else:
                     st.warning("No OpenAI resources found.")
 
@@ -440,26 +606,45 @@ if fetch_btn:
             credential = get_azure_credentials()
             inv = [{"id": f"/subscriptions/{sub_id}/resourceGroups/{rg_name}/providers/Microsoft.CognitiveServices/accounts/{res_name}", 
                     "name": res_name, "deployment_name": "All Models (Aggregated)", "model_name": "Manual", "type": "text"}]
-            df_raw, errors = fetch_detailed_metrics(credential, sub_id, inv, days_to_fetch)
-            df_cost, cost_error = fetch_actual_costs(credential, sub_id, [inv[0]['id']], days_to_fetch)
+            df_raw, errors = fetch_detailed_metrics(credential, get_token_cache(), sub_id, inv, days_to_fetch)
+            df_cost, cost_error = fetch_actual_costs(credential, get_token_cache(), sub_id, [inv[0]['id']], days_to_fetch)
 
     # --- PROCESSING ---
+    if not df_raw.empty:
+        # Low-cardinality labels as categoricals: cheaper groupby hashing and memory
+        for c in ('Account', 'Model', 'Type', 'Deployment', 'Metric'):
+            df_raw[c] = df_raw[c].astype('category')
+
+        # Calculate Energy (images are per unit, everything else per 1k tokens)
+        types = df_raw['Type'].to_numpy()
+        values = df_raw['Value'].to_numpy(dtype=float)
+        is_image = types == 'image'
+        factors = np.select(
+            [types == 'reasoning', types == 'embedding'],
+            [CARBON_FACTORS['reasoning_text'], CARBON_FACTORS['embedding']],
+            default=CARBON_FACTORS['standard_text']
+        )
+        df_raw['kWh'] = np.where(is_image, values * CARBON_FACTORS['image_gen'], values / 1000 * factors)
+
+    # Keep the fetched frames so region/widget changes re-render without refetching
+    st.session_state['pbi_data'] = {
+        "mode": mode, "df_raw": df_raw, "df_cost": df_cost,
+        "debug_logs": debug_logs, "cost_error": cost_error
+    }
+
+pbi_data = st.session_state.get('pbi_data')
+if pbi_data and pbi_data['mode'] == mode:
+    df_raw, df_cost = pbi_data['df_raw'], pbi_data['df_cost']
+    debug_logs, cost_error = pbi_data['debug_logs'], pbi_data['cost_error']
+
     if show_debug:
         with st.expander("Logs"):
             for l in debug_logs: st.text(l)
             if cost_error: st.warning(cost_error)
 
     if not df_raw.empty:
-        # Calculate Energy/Carbon
-        def calc_kwh(row):
-            factor = CARBON_FACTORS.get("standard_text", 0.0004)
-            if row['Type'] == 'image': return row['Value'] * CARBON_FACTORS['image_gen']
-            elif row['Type'] == 'reasoning': factor = CARBON_FACTORS['reasoning_text']
-            elif row['Type'] == 'embedding': factor = CARBON_FACTORS['embedding']
-            return (row['Value'] / 1000) * factor
-
-        df_raw['kWh'] = df_raw.apply(calc_kwh, axis=1)
-        df_raw['Carbon_g'] = df_raw['kWh'] * grid_intensity
+        # Carbon is the only region-dependent column, so it is recomputed per rerun
+        df_raw['Carbon_g'] = df_raw['kWh'].to_numpy() * grid_intensity
         
         # Totals
         total_co2 = df_raw['Carbon_g'].sum()
@@ -480,7 +665,8 @@ if fetch_btn:
         c1.metric("Total Carbon", f"{total_co2:.1f} gCO₂e")
         c2.metric(f"Total Cost ({cost_source})", f"${real_cost:,.2f}")
         c3.metric("Tree Offset", f"{tree_days:.1f} Days")
-        c4.metric("Models Tracked", f"{len(df_raw['Model'].unique())}")
+        # Model is categorical with categories taken from the data, so this is O(1)
+        c4.metric("Models Tracked", f"{df_raw['Model'].cat.categories.size}")
         
         if cost_error:
             st.caption(f"Note: Using estimated cost. {cost_error}")
@@ -492,13 +678,19 @@ if fetch_btn:
         st.subheader("📊 Export & Visualize")
         
         # Group metrics for cleaner export
-        df_export = df_raw.groupby(['TimeStamp', 'Account', 'Model', 'Type']).agg({
+        df_export = df_raw.groupby(['TimeStamp', 'Account', 'Model', 'Type'], sort=False, observed=True).agg({
             'Value': 'sum',
             'Carbon_g': 'sum',
             'kWh': 'sum'
         }).reset_index()
         
+        # Single precision and whole seconds are plenty for reporting; halves the payload
+        df_export = df_export.astype({'Value': 'float32', 'Carbon_g': 'float32', 'kWh': 'float32'})
+        df_export['TimeStamp'] = df_export['TimeStamp'].dt.as_unit('s')
+        
         csv_data = df_export.to_csv(index=False).encode('utf-8')
+        parquet_buf = io.BytesIO()
+        df_export.to_parquet(parquet_buf, compression='zstd', index=False)
         
         col_pbi, col_info = st.columns([1, 2])
         with col_pbi:
@@ -509,23 +701,33 @@ if fetch_btn:
                 mime="text/csv",
                 help="Import this CSV into Power BI Desktop to build custom reports."
             )
+            st.download_button(
+                label="📦 Download as Parquet",
+                data=parquet_buf.getvalue(),
+                file_name="azure_genai_sustainability.parquet",
+                mime="application/vnd.apache.parquet",
+                help="Smaller and faster to load; use Get Data > Parquet in Power BI Desktop."
+            )
         with col_info:
             st.info("To use in Power BI: Open Power BI Desktop > Get Data > Text/CSV > Select this file.")
 
         # --- TABS ---
+        import plotly.express as px  # only needed once there is something to chart
         tab_main, tab_cost = st.tabs(["🚀 Usage & Carbon", "💰 Cost Analysis"])
         
         with tab_main:
             # Usage Charts
             st.subheader("Carbon Emissions by Model")
-            fig_bar = px.bar(df_raw.groupby("Model")["Carbon_g"].sum().reset_index(), x="Model", y="Carbon_g", title="Emissions (gCO2e)")
+            fig_bar = px.bar(df_raw.groupby("Model", observed=True)["Carbon_g"].sum().reset_index(), x="Model", y="Carbon_g", title="Emissions (gCO2e)")
             st.plotly_chart(fig_bar, use_container_width=True)
             
         with tab_cost:
             if not df_cost.empty:
                 st.subheader("Daily Billed Cost")
                 st.dataframe(df_cost)
-                fig_cost = px.bar(df_cost, x="Date", y="ActualCost", title="Daily Spend (USD)")
+                # One bar per day instead of one stacked segment per resource row
+                df_cost_daily = df_cost.groupby("Date", as_index=False, sort=True)["ActualCost"].sum()
+                fig_cost = px.bar(df_cost_daily, x="Date", y="ActualCost", title="Daily Spend (USD)")
                 st.plotly_chart(fig_cost, use_container_width=True)
             else:
                 st.warning("No billing data available. Ensure you have 'Cost Management Reader' permissions.")
@@ -1,12 +1,14 @@
+import os
+
 from arize.otel import register, Transport
 from opentelemetry import trace
 from opentelemetry.trace import SpanKind
 
-# Register Arize OTEL tracer provider
+# Register the Arize OTEL tracer provider; credentials come from the environment, not the source
 tracer_provider = register(
     endpoint="https://otlp.eu-west-1a.arize.com/v1/traces",
-    space_id="U3BhY2U6NTE1OmZaUVc=",
-    api_key="ak-e67a51ed-c916-4165-b425-24d1eab9e4e5-V2RIkfvg6NLxnurC_tjrfm2Z_DLAooUt",
+    space_id=os.environ["ARIZE_SPACE_ID"],
+    api_key=os.environ["ARIZE_API_KEY"],
     project_name="dat-dev-2",
     transport=Transport.HTTP,
 )
@@ -1,14 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly_resampler import FigureResampler
+from plotly_resampler.aggregation import MinMaxLTTB
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import time
 from datetime import datetime, timedelta
 from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
 from azure.mgmt.monitor import MonitorManagementClient
 from azure.mgmt.resource import ResourceManagementClient
 # REMOVED: from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
-import random
+from concurrent.futures import ThreadPoolExecutor
 
 # Page Configuration
 st.set_page_config(
@@ -17,8 +24,10 @@ st.set_page_config(
     layout="wide"
 )
 
-# Custom CSS
-st.markdown("""
+# Custom CSS (built once per process, injected on each rerun)
+@st.cache_resource
+def get_custom_css():
+    return """
 <style>
     .metric-card {
         background-color: #f0f2f6;
@@ -33,7 +42,9 @@ st.markdown("""
         border-radius: 5px;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(get_custom_css(), unsafe_allow_html=True)
 
 # --- CARBON & ENERGY CONSTANTS ---
 # Grid Intensity (gCO2/kWh)
@@ -65,6 +76,18 @@ EXCHANGE_RATES_TO_SEK = {
     "SEK": 1.0
 }
 
+def _get_token(credential):
+    """
+    Returns an ARM bearer token, reusing the one cached in session state until ~1 min before expiry.
+    Avoids repeated get_token calls, which spawn `az` each time with AzureCliCredential.
+    """
+    tok = st.session_state.get('arm_token')
+    if tok and tok['exp'] - 60 > time.time():
+        return tok['val']
+    t = credential.get_token("https://management.azure.com/.default")
+    st.session_state['arm_token'] = {'val': t.token, 'exp': t.expires_on}
+    return t.token
+
 @st.cache_resource
 def get_azure_credentials():
     """Authenticates using Default or Interactive credentials."""
@@ -72,15 +95,15 @@ def get_azure_credentials():
         # 1. Try silent authentication (Managed Identity, Env Vars, Azure CLI)
         # exclude_interactive_browser_credential=True prevents it from trying to open a browser on the server immediately
         credential = DefaultAzureCredential(exclude_interactive_browser_credential=True)
-        # Probe to see if it actually works
-        credential.get_token("https://management.azure.com/.default")
+        # Probe to see if it actually works (the token is kept for reuse)
+        _get_token(credential)
         return credential
     except Exception as e:
         # 2. Fallback to interactive browser login (ONLY works locally)
         try:
             credential = InteractiveBrowserCredential()
             # Probe to trigger the browser popup immediately inside this try block
-            credential.get_token("https://management.azure.com/.default")
+            _get_token(credential)
             return credential
         except Exception as e2:
             st.error(f"Authentication Failed: {e}")
@@ -94,22 +117,36 @@ def get_azure_credentials():
             """)
             return None
 
-def get_deployments(credential, subscription_id, resource_group, account_name):
+# Shared HTTP session: keeps TLS connections to management.azure.com alive across calls
+# and retries throttled (429) / transient gateway errors with backoff.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                      allowed_methods=frozenset({"GET", "POST"}))
+))
+
+# Azure API results are cached so widget reruns don't re-hit the (slow, rate-limited) APIs.
+# The leading underscore on `_credential` keeps it out of the cache key.
+AZURE_CACHE_TTL = 900
+
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def get_deployments(_token, subscription_id, resource_group, account_name):
     """
     Fetches the list of deployments (models) for a specific OpenAI account.
     Uses direct REST API to avoid needing the extra azure-mgmt-cognitiveservices library.
+    Expects a pre-fetched bearer token so parallel callers don't each hit the credential.
     """
     deployments = []
     try:
-        # Get Auth Token
-        token = credential.get_token("https://management.azure.com/.default").token
-        headers = {"Authorization": f"Bearer {token}"}
+        headers = {"Authorization": f"Bearer {_token}"}
         
         # Azure Management API for Deployments
         api_version = "2023-05-01"
         url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{account_name}/deployments?api-version={api_version}"
         
-        response = requests.get(url, headers=headers)
+        response = SESSION.get(url, headers=headers, timeout=30)
         
         if response.status_code == 200:
             items = response.json().get('value', [])
@@ -132,16 +169,18 @@ def get_deployments(credential, subscription_id, resource_group, account_name):
         
     return deployments
 
-def fetch_actual_costs(credential, subscription_id, resource_ids, days=7):
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def fetch_actual_costs(_credential, subscription_id, resource_ids, days=7):
     """
     Fetches REAL billing data from Azure Cost Management API.
     Note: Requires 'Cost Management Reader' permission.
     """
-    cost_data = []
+    # Column-wise buffers, assembled into one DataFrame after all pages are read
+    costs, resids, currs, dates = [], [], [], []
     error_msg = None
     
     try:
-        token = credential.get_token("https://management.azure.com/.default").token
+        token = _get_token(_credential)
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
@@ -182,61 +221,69 @@ def fetch_actual_costs(credential, subscription_id, resource_ids, days=7):
             }
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            result = response.json()
-            properties = result.get('properties', {})
-            columns = properties.get('columns', [])
-            rows = properties.get('rows', [])
+        # Follow nextLink pages: large scopes are truncated to the first page otherwise
+        while url:
+            response = SESSION.post(url, headers=headers, json=payload, timeout=30)
             
-            # Dynamic Column Mapping to handle API variations
-            col_map = {c['name']: i for i, c in enumerate(columns)}
-            
-            for r in rows:
-                # Fetch values dynamically
-                cost_val = r[col_map.get('Cost', 0)]
-                res_id = r[col_map.get('ResourceId', 1)]
+            if response.status_code == 200:
+                result = response.json()
+                properties = result.get('properties', {})
+                columns = properties.get('columns', [])
+                rows = properties.get('rows', [])
                 
+                # Dynamic Column Mapping to handle API variations
+                col_map = {c['name']: i for i, c in enumerate(columns)}
+                cost_idx = col_map.get('Cost', 0)
+                res_idx = col_map.get('ResourceId', 1)
                 # Currency handling - usually returned even if not grouped
-                curr_idx = col_map.get('Currency') 
+                curr_idx = col_map.get('Currency')
                 if curr_idx is None: curr_idx = col_map.get('BillingCurrency')
-                curr = r[curr_idx] if curr_idx is not None else "USD" # Default fallback
-                
-                # Date handling
                 date_idx = col_map.get('UsageDate')
-                date_val = r[date_idx] if date_idx is not None else end_date
                 
-                # Normalize date
-                if isinstance(date_val, int):
-                    date_str = str(date_val)
-                    date_obj = datetime.strptime(date_str, "%Y%m%d")
+                for r in rows:
+                    costs.append(r[cost_idx])
+                    resids.append(r[res_idx])
+                    currs.append(r[curr_idx] if curr_idx is not None else "USD") # Default fallback
+                    dates.append(r[date_idx] if date_idx is not None else end_date)
+                
+                url = properties.get('nextLink')
+            else:
+                if response.status_code == 403:
+                    error_msg = "⚠️ Permission Denied: Your account does not have 'Cost Management Reader' access."
                 else:
-                    date_obj = pd.to_datetime(date_val)
-
-                cost_data.append({
-                    "Date": date_obj,
-                    "ResourceId": res_id,
-                    "ActualCost": cost_val,
-                    "OriginalCurrency": curr
-                })
-        elif response.status_code == 403:
-            error_msg = "⚠️ Permission Denied: Your account does not have 'Cost Management Reader' access."
-        else:
-            error_msg = f"Cost API Error: {response.status_code} - {response.text}"
+                    error_msg = f"Cost API Error: {response.status_code} - {response.text}"
+                break
             
     except Exception as e:
         error_msg = f"Failed to fetch costs: {str(e)}"
-        
-    return pd.DataFrame(cost_data), error_msg
 
-def discover_resources_and_deployments(credential, subscription_id, resource_group=None, hub_name=None):
+    if not costs:
+        return pd.DataFrame(), error_msg
+
+    # Normalize dates in one vectorized pass: UsageDate is usually an int like 20240131,
+    # anything else (ISO strings, the end_date fallback) goes through the generic parser
+    date_col = pd.Series(dates, dtype=object)
+    as_num = pd.to_numeric(date_col, errors='coerce')
+    parsed = pd.to_datetime(as_num.astype('Int64').astype(str), format='%Y%m%d', errors='coerce')
+    missing = parsed.isna()
+    if missing.any():
+        parsed[missing] = pd.to_datetime(date_col[missing], errors='coerce')
+        
+    return pd.DataFrame({
+        "Date": parsed,
+        "ResourceId": resids,
+        "ActualCost": costs,
+        "OriginalCurrency": currs
+    }), error_msg
+
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def discover_resources_and_deployments(_credential, subscription_id, resource_group=None, hub_name=None):
     """
     Finds OpenAI accounts, then drills down to find Deployments (Models) within them.
     Also fetches Tags to identify Projects.
     """
     logs = []
-    resource_client = ResourceManagementClient(credential, subscription_id)
+    resource_client = ResourceManagementClient(_credential, subscription_id)
 
     # 1. Find Accounts (Hub or RG or Subscription)
     found_accounts_list = []
@@ -280,36 +327,31 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
         logs.append(f"Error scanning resources: {e}")
 
     # 2. Drill down into Deployments per Account
-    final_inventory = []
-    
-    # Show progress bar if we have many accounts
+    # Each lookup is a blocking ARM call, so fan them out across a thread pool
+    all_depts = []
     if found_accounts_list:
-        pbar = st.progress(0)
+        # Fetch the bearer token once for the whole fan-out
+        token = _get_token(_credential)
+        with ThreadPoolExecutor(max_workers=min(16, len(found_accounts_list))) as ex:
+            all_depts = list(ex.map(
+                lambda a: get_deployments(token, subscription_id, a['group'], a['name']),
+                found_accounts_list
+            ))
+
+    # Inventory is built column-wise and returned as a single DataFrame (one row per deployment)
+    ids, names, groups, projects, tagss, depl_names, model_names, types = ([] for _ in range(8))
         
-    for i, acct in enumerate(found_accounts_list):
+    for acct, depts in zip(found_accounts_list, all_depts):
         logs.append(f"Inspecting account: {acct['name']}")
-        depts = get_deployments(credential, subscription_id, acct['group'], acct['name'])
-        
-        # Prepare common info for inventory
-        common_info = {
-            "id": acct['id'],
-            "name": acct['name'],
-            "group": acct['group'],
-            "project": acct['project'],
-            "tags": acct['tags']
-        }
         
         if not depts:
             # If no deployments found, add a "General" placeholder
-            final_inventory.append({
-                **common_info,
-                "deployment_name": "All Models (Aggregated)",
-                "model_name": "unknown",
-                "type": "text"
-            })
-        else:
-            for d in depts:
-                # Determine type for carbon math
+            depts = [{"deployment_name": "All Models (Aggregated)", "model_name": "unknown", "type": "text"}]
+
+        for d in depts:
+            # Determine type for carbon math
+            m_type = d.get('type')
+            if m_type is None:
                 m_name = d['model_name'].lower()
                 if "dall" in m_name:
                     m_type = "image"
@@ -320,26 +362,35 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
                 else:
                     m_type = "text"
 
-                final_inventory.append({
-                    **common_info,
-                    "deployment_name": d['deployment_name'],
-                    "model_name": d['model_name'],
-                    "type": m_type
-                })
-        
-        if found_accounts_list:
-            pbar.progress((i + 1) / len(found_accounts_list))
-            
-    if found_accounts_list:
-        pbar.empty()
+            ids.append(acct['id'])
+            names.append(acct['name'])
+            groups.append(acct['group'])
+            projects.append(acct['project'])
+            tagss.append(json.dumps(acct['tags'])) # Serialized so the frame stays hashable for st.cache_data
+            depl_names.append(d['deployment_name'])
+            model_names.append(d['model_name'])
+            types.append(m_type)
+
+    final_inventory = pd.DataFrame({
+        "id": ids,
+        "name": names,
+        "group": groups,
+        "project": projects,
+        "tags": tagss,
+        "deployment_name": depl_names,
+        "model_name": model_names,
+        "type": types
+    })
                 
     return final_inventory, logs
 
-def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
+@st.cache_data(ttl=AZURE_CACHE_TTL, show_spinner=False)
+def fetch_detailed_metrics(_credential, subscription_id, inventory_df, days=7):
     """
-    Fetches usage metrics filtered by Deployment Name to get per-model granularity.
+    Fetches usage metrics split by Deployment Name to get per-model granularity.
+    Issues one Azure Monitor call per account; deployments are recovered from the dimension split.
     """
-    client = MonitorManagementClient(credential, subscription_id)
+    client = MonitorManagementClient(_credential, subscription_id)
     
     # Metrics: 'GeneratedImages' (DALL-E), 'ProcessedPromptTokens'/'GeneratedTokens' (Text)
     metric_names = "ProcessedPromptTokens,GeneratedTokens,GeneratedImages"
@@ -348,68 +399,106 @@ def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
     starttime = endtime - timedelta(days=days)
     timespan = f"{starttime.isoformat()}/{endtime.isoformat()}"
 
-    data_rows = []
+    # Column-wise buffers (one list per output column) instead of a dict per data point
+    timestamps, accounts, resids, projects, depls, models, types, metrics, values = ([] for _ in range(9))
     errors = []
     
     # Group by Account ID to minimize client calls
-    grouped_inventory = {}
-    for item in inventory_list:
-        if item['id'] not in grouped_inventory:
-            grouped_inventory[item['id']] = []
-        grouped_inventory[item['id']].append(item)
+    grouped_inventory = {
+        account_id: grp.to_dict('records')
+        for account_id, grp in inventory_df.groupby('id', sort=False)
+    }
 
-    progress_bar = st.progress(0)
-    total_steps = len(grouped_inventory)
-    current_step = 0
+    def _deployment_of(timeseries):
+        """Returns the ModelDeploymentName dimension value of a split timeseries, if any."""
+        for md in timeseries.metadatavalues or []:
+            if md.name and md.name.value and md.name.value.lower() == "modeldeploymentname":
+                return md.value
+        return None
+
+    def _collect(metrics_data, account_id, resolve_dept):
+        for item in metrics_data.value:
+            metric_name = item.name.value
+            for timeseries in item.timeseries:
+                dept = resolve_dept(timeseries)
+                if dept is None:
+                    continue
+                for data in timeseries.data:
+                    if data.total and data.total > 0:
+                        timestamps.append(data.time_stamp)
+                        accounts.append(dept['name'])
+                        resids.append(account_id)
+                        projects.append(dept['project']) # Key addition
+                        depls.append(dept['deployment_name'])
+                        models.append(dept['model_name'])
+                        types.append(dept['type'])
+                        metrics.append(metric_name)
+                        values.append(data.total)
 
     for account_id, deployments in grouped_inventory.items():
         try:
-            for dept in deployments:
-                dept_name = dept['deployment_name']
-                is_agg = dept_name == "All Models (Aggregated)"
-                
-                # Filter syntax for Azure Monitor
-                odata_filter = f"ModelDeploymentName eq '{dept_name}'" if not is_agg else None
-                
+            if len(deployments) == 1 and deployments[0]['deployment_name'] == "All Models (Aggregated)":
+                # No deployments listed: account-level totals, no dimension filter
+                metrics_data = client.metrics.list(
+                    resource_uri=account_id,
+                    timespan=timespan,
+                    interval="PT1H",
+                    metricnames=metric_names,
+                    aggregation="Total"
+                )
+                _collect(metrics_data, account_id, lambda ts: deployments[0])
+            else:
+                # One call per account, split server-side by deployment
+                dept_by_name = {d['deployment_name']: d for d in deployments}
                 metrics_data = client.metrics.list(
                     resource_uri=account_id,
                     timespan=timespan,
                     interval="PT1H",
                     metricnames=metric_names,
                     aggregation="Total",
-                    filter=odata_filter 
+                    top=max(10, len(deployments)),
+                    orderby="Total desc",
+                    filter="ModelDeploymentName eq '*'"
                 )
-                
-                for item in metrics_data.value:
-                    metric_name = item.name.value
-                    for timeseries in item.timeseries:
-                        for data in timeseries.data:
-                            if data.total and data.total > 0:
-                                data_rows.append({
-                                    "TimeStamp": data.time_stamp,
-                                    "Account": dept['name'],
-                                    "ResourceId": account_id,
-                                    "Project": dept['project'], # Key addition
-                                    "Deployment": dept_name,
-                                    "Model": dept['model_name'],
-                                    "Type": dept['type'],
-                                    "Metric": metric_name,
-                                    "Value": data.total
-                                })
+                series = [ts for item in metrics_data.value for ts in item.timeseries]
+                if not series or any(_deployment_of(ts) is not None for ts in series):
+                    _collect(metrics_data, account_id, lambda ts: dept_by_name.get(_deployment_of(ts)))
+                else:
+                    # Resource did not return the dimension split: fall back to one filtered call per deployment
+                    for dept in deployments:
+                        metrics_data = client.metrics.list(
+                            resource_uri=account_id,
+                            timespan=timespan,
+                            interval="PT1H",
+                            metricnames=metric_names,
+                            aggregation="Total",
+                            filter=f"ModelDeploymentName eq '{dept['deployment_name']}'"
+                        )
+                        _collect(metrics_data, account_id, lambda ts, dept=dept: dept)
 
         except Exception as e:
             if "BadRequest" not in str(e): 
                 errors.append(f"Error {account_id.split('/')[-1]}: {str(e)}")
-        
-        current_step += 1
-        progress_bar.progress(current_step / total_steps)
-        
-    progress_bar.empty()
-    return pd.DataFrame(data_rows), errors
+
+    if not timestamps:
+        return pd.DataFrame(), errors
+
+    return pd.DataFrame({
+        "TimeStamp": timestamps,
+        "Account": accounts,
+        "ResourceId": resids,
+        "Project": projects,
+        "Deployment": depls,
+        "Model": models,
+        "Type": types,
+        "Metric": metrics,
+        "Value": values
+    }), errors
 
 def generate_demo_data_detailed(days=7):
     dates = pd.date_range(end=datetime.now(), periods=days*24, freq='H')
-    data = []
+    n_hours = len(dates)
+    rng = np.random.default_rng(42)
     
     # Demo Projects matching user patterns
     projects = [
@@ -417,50 +506,93 @@ def generate_demo_data_detailed(days=7):
         {"name": "113527-volvogpt", "model": "gpt-4", "type": "text", "res_name": "ai-res-02"},
         {"name": "rd-usecases", "model": "dall-e-3", "type": "image", "res_name": "ai-res-03"}
     ]
-    
-    for date in dates:
-        hour_mod = 10 if 9 <= date.hour <= 17 else 1
-        
-        for p in projects:
-            if p['type'] == 'image':
-                val = int(random.random() * 5 * hour_mod) if hour_mod > 1 else 0
-                if val > 0:
-                    data.append({
-                        "TimeStamp": date, "Model": p['model'], "Type": "image", "Metric": "GeneratedImages", 
-                        "Value": val, "Deployment": "dep-1", 
-                        "ResourceId": f"/subscriptions/s/resourceGroups/{p['name']}/providers/Microsoft.CognitiveServices/accounts/{p['res_name']}", 
-                        "Account": p['res_name'], "Project": p['name']
-                    })
-            else:
-                prompts = int(random.gauss(500, 100) * hour_mod)
-                gens = int(random.gauss(200, 50) * hour_mod)
-                if prompts > 0:
-                    data.append({
-                        "TimeStamp": date, "Model": p['model'], "Type": "text", "Metric": "ProcessedPromptTokens", 
-                        "Value": prompts, "Deployment": "dep-1", 
-                        "ResourceId": f"/subscriptions/s/resourceGroups/{p['name']}/providers/Microsoft.CognitiveServices/accounts/{p['res_name']}", 
-                        "Account": p['res_name'], "Project": p['name']
-                    })
-                    data.append({
-                        "TimeStamp": date, "Model": p['model'], "Type": "text", "Metric": "GeneratedTokens", 
-                        "Value": gens, "Deployment": "dep-1", 
-                        "ResourceId": f"/subscriptions/s/resourceGroups/{p['name']}/providers/Microsoft.CognitiveServices/accounts/{p['res_name']}", 
-                        "Account": p['res_name'], "Project": p['name']
-                    })
+
+    # Office hours (9-17) get 10x traffic
+    hours = dates.hour.to_numpy()
+    hour_mod = np.where((hours >= 9) & (hours <= 17), 10, 1)
+
+    frames = []
+    for p in projects:
+        common = {
+            "Deployment": "dep-1",
+            "ResourceId": f"/subscriptions/s/resourceGroups/{p['name']}/providers/Microsoft.CognitiveServices/accounts/{p['res_name']}",
+            "Account": p['res_name'],
+            "Project": p['name']
+        }
+        if p['type'] == 'image':
+            imgs = np.where(hour_mod > 1, (rng.random(n_hours) * 5 * hour_mod).astype(int), 0)
+            keep = imgs > 0
+            frames.append(pd.DataFrame({
+                "TimeStamp": dates[keep], "Model": p['model'], "Type": "image", "Metric": "GeneratedImages",
+                "Value": imgs[keep], **common
+            }))
+        else:
+            prompts = (rng.normal(500, 100, n_hours) * hour_mod).astype(int)
+            gens = (rng.normal(200, 50, n_hours) * hour_mod).astype(int)
+            keep = prompts > 0
+            n_keep = int(keep.sum())
+            frames.append(pd.DataFrame({
+                "TimeStamp": np.concatenate([dates[keep], dates[keep]]), "Model": p['model'], "Type": "text",
+                "Metric": np.repeat(["ProcessedPromptTokens", "GeneratedTokens"], n_keep),
+                "Value": np.concatenate([prompts[keep], gens[keep]]), **common
+            }))
     
     # Fake Cost Data for Demo (SEK)
-    cost_data = []
-    unique_days = sorted(list(set([d.date() for d in dates])))
-    for d in unique_days:
-        for p in projects:
-            cost_data.append({
-                "Date": pd.to_datetime(d),
-                "ActualCost": random.uniform(50, 500),
-                "OriginalCurrency": "SEK",
-                "ResourceId": f"/subscriptions/s/resourceGroups/{p['name']}/providers/Microsoft.CognitiveServices/accounts/{p['res_name']}"
-            })
+    unique_days = dates.normalize().unique()
+    df_cost = pd.DataFrame({
+        "Date": np.repeat(unique_days, len(projects)),
+        "ActualCost": rng.uniform(50, 500, len(unique_days) * len(projects)),
+        "OriginalCurrency": "SEK",
+        "ResourceId": np.tile(
+            [f"/subscriptions/s/resourceGroups/{p['name']}/providers/Microsoft.CognitiveServices/accounts/{p['res_name']}" for p in projects],
+            len(unique_days)
+        )
+    })
                     
-    return pd.DataFrame(data), pd.DataFrame(cost_data)
+    return pd.concat(frames, ignore_index=True), df_cost
+
+# --- CHART BUILDERS ---
+# Figures are memoized as Plotly JSON keyed on their (already aggregated) input frame,
+# so reruns from unrelated widgets skip the Python-side trace construction.
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_model_bar(df_model):
+    fig = px.bar(df_model, x="Model", y="Carbon_g", color="Model", title="Total Carbon (gCO2e)", text_auto='.1f')
+    return fig.to_json()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_token_volume(df_text_plot):
+    # WebGL line per metric, LTTB-downsampled server-side so at most
+    # ~1000 points per trace are shipped to the browser
+    fig = FigureResampler(
+        go.Figure(),
+        default_n_shown_samples=1000,
+        default_downsampler=MinMaxLTTB(),
+        resampled_trace_prefix_suffix=("", ""),
+        show_mean_aggregation_size=False
+    )
+    for metric_name, df_m in df_text_plot.groupby('Metric', observed=True):
+        fig.add_trace(go.Scattergl(mode='lines', name=metric_name), hf_x=df_m['TimeStamp'], hf_y=df_m['Value'])
+    fig.update_layout(title="Token Volume", xaxis_title="TimeStamp", yaxis_title="Value", legend_title="Metric")
+    return fig.to_json()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_images_bar(df_img_plot):
+    return px.bar(df_img_plot, x="TimeStamp", y="Value", title="Images Created").to_json()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_cost_trend(df_cost_plot):
+    fig = px.bar(
+        df_cost_plot, 
+        x="Date", 
+        y="CostSEK", 
+        color="ProjectName",
+        title="Total Cost (SEK) by Month and Digital Product",
+        labels={"CostSEK": "Cost (SEK)", "Date": "Month"},
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    fig.update_layout(hovermode="x unified")
+    return fig.to_json()
 
 # --- UI LAYOUT ---
 
@@ -480,27 +612,41 @@ with st.sidebar:
     st.caption("Exchange rates used if Azure returns USD/EUR.")
     usd_rate = st.number_input("USD to SEK Rate", value=10.8, step=0.1)
     
+    # Azure scope inputs live in a form: editing them doesn't rerun the app,
+    # only the submit buttons trigger a fetch
     if mode == "Auto-Discovery":
-        sub_id = st.text_input("Subscription ID", type="password")
-        with st.expander("Filter Scope (Optional)"):
-             rg_name = st.text_input("Resource Group Name")
-        days_to_fetch = st.slider("Days history", 1, 30, 7)
-        show_debug = st.checkbox("Show Debug Logs")
-        fetch_btn = st.button("Discover & Analyze")
+        with st.form("params"):
+            sub_id = st.text_input("Subscription ID", type="password")
+            with st.expander("Filter Scope (Optional)"):
+                 rg_name = st.text_input("Resource Group Name")
+            days_to_fetch = st.slider("Days history", 1, 30, 7)
+            show_debug = st.checkbox("Show Debug Logs")
+            fetch_btn = st.form_submit_button("Discover & Analyze")
+            refresh_btn = st.form_submit_button("🔄 Refresh Azure Data", help="Clear cached Azure results and fetch again.")
         
     elif mode == "Manual Input":
-        sub_id = st.text_input("Subscription ID", type="password")
-        rg_name = st.text_input("Resource Group")
-        res_name = st.text_input("OpenAI Resource Name")
-        days_to_fetch = st.slider("Days history", 1, 30, 7)
-        fetch_btn = st.button("Fetch Data")
+        with st.form("params"):
+            sub_id = st.text_input("Subscription ID", type="password")
+            rg_name = st.text_input("Resource Group")
+            res_name = st.text_input("OpenAI Resource Name")
+            days_to_fetch = st.slider("Days history", 1, 30, 7)
+            fetch_btn = st.form_submit_button("Fetch Data")
+            refresh_btn = st.form_submit_button("🔄 Refresh Azure Data", help="Clear cached Azure results and fetch again.")
         show_debug = False
     else:
         fetch_btn = True
+        refresh_btn = False
         days_to_fetch = 7
         sub_id = ""
         show_debug = False
 
+if refresh_btn:
+    get_deployments.clear()
+    fetch_actual_costs.clear()
+    discover_resources_and_deployments.clear()
+    fetch_detailed_metrics.clear()
+    fetch_btn = True
+
 if fetch_btn:
     df_raw = pd.DataFrame()
     df_cost = pd.DataFrame()
@@ -509,7 +655,7 @@ if fetch_btn:
     cost_error = None
     
     # Need to keep inventory for cost mapping
-    final_inventory = []
+    final_inventory = pd.DataFrame()
     
     if mode == "Demo Data":
         df_raw, df_cost = generate_demo_data_detailed(days_to_fetch)
@@ -527,7 +673,7 @@ if fetch_btn:
                 with st.spinner("🔍 Scanning for Accounts & Deployments..."):
                     final_inventory, debug_logs = discover_resources_and_deployments(credential, sub_id, rg_name if 'rg_name' in locals() and rg_name else None)
                 
-                if final_inventory:
+                if not final_inventory.empty:
                     st.success(f"✅ Found {len(final_inventory)} model deployments across your resources.")
                     
                     # 1. Fetch Carbon/Usage Metrics
@@ -536,7 +682,7 @@ if fetch_btn:
                         
                     # 2. Fetch Cost Data
                     with st.spinner("💰 Fetching billing data..."):
-                        unique_res_ids = list(set([item['id'] for item in final_inventory]))
+                        unique_res_ids = final_inventory['id'].unique().tolist()
                         if unique_res_ids:
                             df_cost, cost_error = fetch_actual_costs(credential, sub_id, unique_res_ids, days_to_fetch)
                 else:
@@ -546,14 +692,55 @@ if fetch_btn:
         if sub_id and rg_name and res_name:
             credential = get_azure_credentials()
             # Manual assumes Name is Project for simplicity
-            inv = [{"id": f"/subscriptions/{sub_id}/resourceGroups/{rg_name}/providers/Microsoft.CognitiveServices/accounts/{res_name}", 
-                    "name": res_name, "deployment_name": "All Models (Aggregated)", "model_name": "Manual", "type": "text", 
-                    "group": rg_name, "project": rg_name, "tags": {}}]
+            inv = pd.DataFrame([{"id": f"/subscriptions/{sub_id}/resourceGroups/{rg_name}/providers/Microsoft.CognitiveServices/accounts/{res_name}", 
+                    "name": res_name, "group": rg_name, "project": rg_name, "tags": "{}",
+                    "deployment_name": "All Models (Aggregated)", "model_name": "Manual", "type": "text"}])
             final_inventory = inv
             df_raw, errors = fetch_detailed_metrics(credential, sub_id, inv, days_to_fetch)
-            df_cost, cost_error = fetch_actual_costs(credential, sub_id, [inv[0]['id']], days_to_fetch)
+            df_cost, cost_error = fetch_actual_costs(credential, sub_id, [inv['id'].iloc[0]], days_to_fetch)
+
+    # Region/currency-independent preprocessing happens once per fetch
+    if not df_raw.empty:
+        # 0. Compact dtypes: repeated labels as categories, measures as float32
+        for c in ['Metric', 'Type', 'Model', 'Project', 'Account', 'Deployment']:
+            df_raw[c] = df_raw[c].astype('category')
+        df_raw['Value'] = df_raw['Value'].astype('float32')
+        if not df_cost.empty:
+            df_cost['OriginalCurrency'] = df_cost['OriginalCurrency'].astype('category')
+
+        # 1. Energy per row: gather a kWh-per-unit table by Type code, then one in-place multiply.
+        # Images are per unit, everything else per 1k tokens. Unknown types get code -1,
+        # which indexes the trailing standard_text entry.
+        kwh_per_unit = np.array([
+            CARBON_FACTORS['standard_text'] / 1000,
+            CARBON_FACTORS['image_gen'],
+            CARBON_FACTORS['reasoning_text'] / 1000,
+            CARBON_FACTORS['embedding'] / 1000,
+            CARBON_FACTORS['standard_text'] / 1000
+        ], dtype=np.float32)
+        type_code = pd.Categorical(df_raw['Type'], categories=['text', 'image', 'reasoning', 'embedding']).codes
+        kwh = kwh_per_unit[type_code]
+        np.multiply(kwh, df_raw['Value'].to_numpy(dtype=np.float32), out=kwh)
+        df_raw['kWh'] = kwh
+
+        # 2. Newest-first order for the Data tab, done once here rather than on every render
+        df_raw = df_raw.sort_values("TimeStamp", ascending=False, kind='stable', ignore_index=True)
+
+    st.session_state['df_raw'] = df_raw
+    st.session_state['df_cost'] = df_cost
+    st.session_state['inv'] = final_inventory
+    st.session_state['fetch_info'] = {"mode": mode, "debug_logs": debug_logs, "errors": errors, "cost_error": cost_error}
+
+# --- PROCESSING & VISUALIZATION ---
+# The last fetched frames persist in session state, so region/currency changes
+# only recompute the cheap derived columns (Carbon_g, CostSEK) without hitting Azure.
+fetch_info = st.session_state.get('fetch_info')
+if fetch_info and fetch_info['mode'] == mode:
+    df_raw = st.session_state['df_raw']
+    df_cost = st.session_state['df_cost']
+    final_inventory = st.session_state['inv']
+    debug_logs, errors, cost_error = fetch_info['debug_logs'], fetch_info['errors'], fetch_info['cost_error']
 
-    # --- PROCESSING & VISUALIZATION ---
     if show_debug and (debug_logs or errors):
         with st.expander("Logs"):
             for l in debug_logs: st.text(l)
@@ -561,18 +748,7 @@ if fetch_btn:
             if cost_error: st.warning(cost_error)
 
     if not df_raw.empty:
-        # 1. Carbon Calculations
-        def calc_kwh(row):
-            factor = CARBON_FACTORS.get("standard_text", 0.0004)
-            if row['Type'] == 'image':
-                return row['Value'] * CARBON_FACTORS['image_gen']
-            elif row['Type'] == 'reasoning':
-                factor = CARBON_FACTORS['reasoning_text']
-            elif row['Type'] == 'embedding':
-                factor = CARBON_FACTORS['embedding']
-            return (row['Value'] / 1000) * factor
-
-        df_raw['kWh'] = df_raw.apply(calc_kwh, axis=1)
+        # 1. Carbon Calculations (depends on the selected region)
         df_raw['Carbon_g'] = df_raw['kWh'] * grid_intensity
         
         total_co2 = df_raw['Carbon_g'].sum()
@@ -583,22 +759,16 @@ if fetch_btn:
         total_cost_sek = 0.0
         
         if not df_cost.empty:
-            # Conversion Logic
-            def convert_to_sek(row):
-                curr = row['OriginalCurrency']
-                val = row['ActualCost']
-                if curr == "SEK": return val
-                elif curr == "USD": return val * usd_rate
-                elif curr == "EUR": return val * EXCHANGE_RATES_TO_SEK.get("EUR", 11.5)
-                else: return val * EXCHANGE_RATES_TO_SEK.get(curr, 1.0)
-            
-            df_cost['CostSEK'] = df_cost.apply(convert_to_sek, axis=1)
+            # Conversion Logic (live USD rate overrides the fallback table)
+            rate_table = {**EXCHANGE_RATES_TO_SEK, "SEK": 1.0, "USD": usd_rate}
+            rates = df_cost['OriginalCurrency'].map(rate_table).astype(float).fillna(1.0).to_numpy()
+            df_cost['CostSEK'] = df_cost['ActualCost'].to_numpy() * rates
             total_cost_sek = df_cost['CostSEK'].sum()
             
             # Map ResourceId to PROJECT NAME
             # Create mapping from inventory if available, else fallback to extracting RG
-            if final_inventory:
-                id_to_proj = {item['id']: item.get('project', item['group']) for item in final_inventory}
+            if not final_inventory.empty:
+                id_to_proj = dict(zip(final_inventory['id'], final_inventory['project']))
                 df_cost['ProjectName'] = df_cost['ResourceId'].map(id_to_proj).fillna('Unknown')
             else:
                 # If demo or manual, we might already have it or need to extract
@@ -607,7 +777,8 @@ if fetch_btn:
                 if 'Project' in df_cost.columns:
                      df_cost['ProjectName'] = df_cost['Project'] # From demo data
                 else:
-                     df_cost['ProjectName'] = df_cost['ResourceId'].apply(lambda x: x.split('/')[4] if isinstance(x, str) and len(x.split('/')) > 4 else 'Unknown')
+                     # Vectorized split; short or non-string IDs yield NaN -> 'Unknown'
+                     df_cost['ProjectName'] = df_cost['ResourceId'].str.split('/').str[4].fillna('Unknown')
         
         # KPI Row
         c1, c2, c3, c4 = st.columns(4)
@@ -623,12 +794,12 @@ if fetch_btn:
         
         with tab_models:
             st.subheader("Which model is the heaviest emitter?")
-            df_model = df_raw.groupby("Model")[["Carbon_g", "Value"]].sum().reset_index()
+            df_model = df_raw.groupby("Model", observed=True)[["Carbon_g", "Value"]].sum().reset_index()
             df_model = df_model.sort_values("Carbon_g", ascending=False)
             
             col_chart, col_details = st.columns([2, 1])
             with col_chart:
-                fig_bar = px.bar(df_model, x="Model", y="Carbon_g", color="Model", title="Total Carbon (gCO2e)", text_auto='.1f')
+                fig_bar = go.Figure(json.loads(build_model_bar(df_model)))
                 st.plotly_chart(fig_bar, use_container_width=True)
             with col_details:
                 st.write("**Breakdown:**")
@@ -636,19 +807,28 @@ if fetch_btn:
 
         with tab_features:
             c_a, c_b = st.columns(2)
-            df_text = df_raw[df_raw['Metric'].isin(['ProcessedPromptTokens', 'GeneratedTokens'])]
-            df_img = df_raw[df_raw['Metric'] == 'GeneratedImages']
+            # Boolean masks computed once; only the plotted columns are copied out
+            metric_col = df_raw['Metric']
+            text_mask = metric_col.isin(['ProcessedPromptTokens', 'GeneratedTokens']).to_numpy()
+            img_mask = (metric_col == 'GeneratedImages').to_numpy()
+            df_text = df_raw.loc[text_mask, ['TimeStamp', 'Metric', 'Value']]
+            df_img = df_raw.loc[img_mask, ['TimeStamp', 'Value']]
+
+            # Collapse deployments/projects before plotting: one point per (time, metric)
+            df_text_plot = df_text.groupby(['TimeStamp', 'Metric'], observed=True, as_index=False)['Value'].sum()
+            df_img_plot = df_img.groupby(pd.Grouper(key='TimeStamp', freq='D'))['Value'].sum().reset_index()
             
             with c_a:
                 st.markdown("#### 📝 Text Usage")
-                if not df_text.empty:
-                    fig_text = px.area(df_text, x="TimeStamp", y="Value", color="Metric", title="Token Volume")
+                if not df_text_plot.empty:
+                    fig_text = go.Figure(json.loads(build_token_volume(df_text_plot)))
                     st.plotly_chart(fig_text, use_container_width=True)
                 else: st.info("No text usage.")
             with c_b:
                 st.markdown("#### 🖼️ Image Generation")
-                if not df_img.empty:
-                    fig_img = px.bar(df_img, x="TimeStamp", y="Value", title="Images Created")
+                if not df_img_plot.empty:
+                    # Daily totals keep the bar count at `days` regardless of deployment count
+                    fig_img = go.Figure(json.loads(build_images_bar(df_img_plot)))
                     st.plotly_chart(fig_img, use_container_width=True)
                 else: st.info("No image data.")
 
@@ -657,27 +837,42 @@ if fetch_btn:
             
             # --- DATA PREPARATION FOR PROJECT SUMMARY ---
             # 1. Agg Usage/Carbon per Project (Using 'Project' col)
-            df_usage_agg = df_raw.groupby('Project').agg(
+            # Mask token values per metric first so the groupby is a plain sum
+            metric_arr = df_raw['Metric'].to_numpy()
+            value_arr = df_raw['Value'].to_numpy()
+            df_usage_agg = df_raw[['Project', 'Carbon_g']].assign(
+                InTok=np.where(metric_arr == 'ProcessedPromptTokens', value_arr, 0),
+                OutTok=np.where(np.isin(metric_arr, ['GeneratedTokens', 'GeneratedCompletionTokens']), value_arr, 0)
+            ).groupby('Project', sort=False, as_index=False, observed=True).agg(
                 Carbon_Total=('Carbon_g', 'sum'),
-                Input_Tokens=('Value', lambda x: x[df_raw.loc[x.index, 'Metric'] == 'ProcessedPromptTokens'].sum()),
-                Output_Tokens=('Value', lambda x: x[df_raw.loc[x.index, 'Metric'].isin(['GeneratedTokens', 'GeneratedCompletionTokens'])].sum())
-            ).reset_index()
+                Input_Tokens=('InTok', 'sum'),
+                Output_Tokens=('OutTok', 'sum')
+            )
             
             # 2. Agg Cost per Project (ProjectName)
             df_cost_agg = pd.DataFrame()
             if not df_cost.empty:
-                df_cost_agg = df_cost.groupby('ProjectName').agg(
+                df_cost_agg = df_cost.groupby('ProjectName', sort=False, as_index=False).agg(
                     Cost_SEK=('CostSEK', 'sum')
-                ).reset_index()
+                )
             
             # 3. Merge Cost and Usage
             if not df_cost_agg.empty:
+                # Join on a shared categorical dtype so pandas matches integer codes, not strings
+                proj_dtype = pd.CategoricalDtype(
+                    pd.Index(df_usage_agg['Project'].astype(str)).union(pd.Index(df_cost_agg['ProjectName'].astype(str)))
+                )
+                df_usage_agg['Project'] = df_usage_agg['Project'].astype(str).astype(proj_dtype)
+                df_cost_agg['ProjectName'] = df_cost_agg['ProjectName'].astype(str).astype(proj_dtype)
                 df_project_summary = pd.merge(df_cost_agg, df_usage_agg, left_on='ProjectName', right_on='Project', how='outer')
                 df_project_summary['ProjectName'] = df_project_summary['ProjectName'].fillna(df_project_summary['Project'])
-                df_project_summary = df_project_summary.drop(columns=['Project']).fillna(0)
+                df_project_summary = df_project_summary.drop(columns=['Project']).fillna(
+                    {'Cost_SEK': 0, 'Carbon_Total': 0, 'Input_Tokens': 0, 'Output_Tokens': 0}
+                )
             else:
                 df_project_summary = df_usage_agg.rename(columns={'Project': 'ProjectName'})
                 df_project_summary['Cost_SEK'] = 0.0
+            df_project_summary = df_project_summary.sort_values("Cost_SEK", ascending=False, ignore_index=True)
 
             # --- TOP KPIs ---
             kpi_c1, kpi_c2, kpi_c3, kpi_c4 = st.columns(4)
@@ -697,16 +892,7 @@ if fetch_btn:
             with c_chart:
                 if not df_cost.empty:
                     # Stacked Bar Chart (Cost by Project over Time)
-                    fig_trend = px.bar(
-                        df_cost, 
-                        x="Date", 
-                        y="CostSEK", 
-                        color="ProjectName",
-                        title="Total Cost (SEK) by Month and Digital Product",
-                        labels={"CostSEK": "Cost (SEK)", "Date": "Month"},
-                        color_discrete_sequence=px.colors.qualitative.Pastel
-                    )
-                    fig_trend.update_layout(hovermode="x unified")
+                    fig_trend = go.Figure(json.loads(build_cost_trend(df_cost[['Date', 'CostSEK', 'ProjectName']])))
                     st.plotly_chart(fig_trend, use_container_width=True)
                 else:
                     st.info("No cost data to visualize trends.")
@@ -715,7 +901,7 @@ if fetch_btn:
                 # Detailed Project Table
                 st.markdown("#### Project Details")
                 st.dataframe(
-                    df_project_summary.sort_values("Cost_SEK", ascending=False),
+                    df_project_summary,
                     column_config={
                         "ProjectName": "Digital Product / Project",
                         "Cost_SEK": st.column_config.NumberColumn("Consumption Cost", format="%.2f kr"),
@@ -728,7 +914,7 @@ if fetch_btn:
                 )
 
         with tab_data:
-            st.dataframe(df_raw.sort_values("TimeStamp", ascending=False), use_container_width=True)
+            st.dataframe(df_raw, use_container_width=True)
             
     elif not show_debug:
         st.info("No data returned. Check Debug Logs or ensure your models have traffic.")
\ No newline at end of file
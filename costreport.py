@@ -1,14 +1,18 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import base64
+import hashlib
+import threading
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-from azure.mgmt.monitor import MonitorManagementClient
-from azure.mgmt.resource import ResourceManagementClient
 # REMOVED: from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
-import random
 
 # Page Configuration
 st.set_page_config(
@@ -65,12 +69,50 @@ EXCHANGE_RATES_TO_SEK = {
     "SEK": 1.0
 }
 
+# Resource IDs per Cost Management query
+COST_QUERY_CHUNK = 20
+
+# On-disk snapshots of fetched frames, reused across restarts while younger than this
+CACHE_DIR = Path(".app_cache")
+DISK_CACHE_MAX_AGE = 3600
+
+@st.cache_resource
+def get_session():
+    """Keep-alive session shared across reruns so management.azure.com connections are reused."""
+    s = requests.Session()
+    s.mount('https://', HTTPAdapter(
+        pool_connections=16, pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods={"GET", "POST"})
+    ))
+    return s
+
+# Resolved once per run on the main thread; worker threads use this handle
+_SESSION = get_session()
+
+@st.cache_resource
+def _token_store():
+    """Bearer tokens per credential, shared across reruns."""
+    return {"lock": threading.Lock(), "tokens": {}}
+
+def get_mgmt_token(credential):
+    """Returns a management.azure.com bearer string, refreshed only within 5 minutes of expiry."""
+    store = _token_store()
+    with store["lock"]:
+        token = store["tokens"].get(id(credential))
+        if token is None or time.time() > token.expires_on - 300:
+            token = credential.get_token("https://management.azure.com/.default")
+            store["tokens"][id(credential)] = token
+        return token.token
+
 @st.cache_resource
 def get_azure_credentials():
     """Authenticates using Default or Interactive credentials."""
+    # Azure SDK imports are deferred so Demo mode never loads them
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
     try:
         credential = DefaultAzureCredential()
-        credential.get_token("https://management.azure.com/.default")
+        get_mgmt_token(credential)
         return credential
     except Exception as e:
         print(f"DefaultAuth failed: {e}")
@@ -80,22 +122,20 @@ def get_azure_credentials():
             st.error(f"Authentication failed: {e2}")
             return None
 
-def get_deployments(credential, subscription_id, resource_group, account_name):
+def get_deployments(token, subscription_id, resource_group, account_name):
     """
     Fetches the list of deployments (models) for a specific OpenAI account.
     Uses direct REST API to avoid needing the extra azure-mgmt-cognitiveservices library.
     """
     deployments = []
     try:
-        # Get Auth Token
-        token = credential.get_token("https://management.azure.com/.default").token
         headers = {"Authorization": f"Bearer {token}"}
         
         # Azure Management API for Deployments
         api_version = "2023-05-01"
         url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{account_name}/deployments?api-version={api_version}"
         
-        response = requests.get(url, headers=headers)
+        response = _SESSION.get(url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             items = response.json().get('value', [])
@@ -118,16 +158,17 @@ def get_deployments(credential, subscription_id, resource_group, account_name):
         
     return deployments
 
-def fetch_actual_costs(credential, subscription_id, resource_ids, days=7):
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_actual_costs(_credential, subscription_id, resource_ids, days=7):
     """
     Fetches REAL billing data from Azure Cost Management API.
     Note: Requires 'Cost Management Reader' permission.
     """
-    cost_data = []
+    dates, resids, costs, currs = [], [], [], []
     error_msg = None
     
     try:
-        token = credential.get_token("https://management.azure.com/.default").token
+        token = get_mgmt_token(_credential)
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
@@ -140,86 +181,106 @@ def fetch_actual_costs(credential, subscription_id, resource_ids, days=7):
         end_date = datetime.utcnow()
         start_date = end_date - timedelta(days=days)
         
-        # Payload for Cost Query
-        # We group by ResourceId to match our Inventory
-        # NOTE: Removed 'Currency' grouping as it causes 400 Bad Request in some scopes
-        payload = {
-            "type": "ActualCost",
-            "timeframe": "Custom",
-            "timePeriod": {
-                "from": start_date.strftime("%Y-%m-%dT00:00:00+00:00"),
-                "to": end_date.strftime("%Y-%m-%dT00:00:00+00:00")
-            },
-            "dataset": {
-                "granularity": "Daily",
-                "aggregation": {
-                    "totalCost": {"name": "Cost", "function": "Sum"}
+        def query_chunk(ids):
+            """Runs the cost query for one slice of resource IDs; returns column lists and an error."""
+            out = ([], [], [], [])
+            # Payload for Cost Query
+            # We group by ResourceId to match our Inventory
+            # NOTE: Removed 'Currency' grouping as it causes 400 Bad Request in some scopes
+            payload = {
+                "type": "ActualCost",
+                "timeframe": "Custom",
+                "timePeriod": {
+                    "from": start_date.strftime("%Y-%m-%dT00:00:00+00:00"),
+                    "to": end_date.strftime("%Y-%m-%dT00:00:00+00:00")
                 },
-                "grouping": [
-                    {"type": "Dimension", "name": "ResourceId"}
-                ],
-                "filter": {
-                    "dimensions": {
-                        "name": "ResourceId",
-                        "operator": "In",
-                        "values": resource_ids
+                "dataset": {
+                    "granularity": "Daily",
+                    "aggregation": {
+                        "totalCost": {"name": "Cost", "function": "Sum"}
+                    },
+                    "grouping": [
+                        {"type": "Dimension", "name": "ResourceId"}
+                    ],
+                    "filter": {
+                        "dimensions": {
+                            "name": "ResourceId",
+                            "operator": "In",
+                            "values": ids
+                        }
                     }
                 }
             }
-        }
-        
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            result = response.json()
-            properties = result.get('properties', {})
-            columns = properties.get('columns', [])
-            rows = properties.get('rows', [])
-            
-            # Dynamic Column Mapping to handle API variations
-            col_map = {c['name']: i for i, c in enumerate(columns)}
             
-            for r in rows:
-                # Fetch values dynamically
-                cost_val = r[col_map.get('Cost', 0)]
-                res_id = r[col_map.get('ResourceId', 1)]
-                
-                # Currency handling - usually returned even if not grouped
-                curr_idx = col_map.get('Currency') 
-                if curr_idx is None: curr_idx = col_map.get('BillingCurrency')
-                curr = r[curr_idx] if curr_idx is not None else "USD" # Default fallback
-                
-                # Date handling
-                date_idx = col_map.get('UsageDate')
-                date_val = r[date_idx] if date_idx is not None else end_date
+            # Large results are paged; nextLink takes the same body
+            page_url = url
+            while page_url:
+                response = _SESSION.post(page_url, headers=headers, json=payload, timeout=60)
                 
-                # Normalize date
-                if isinstance(date_val, int):
-                    date_str = str(date_val)
-                    date_obj = datetime.strptime(date_str, "%Y%m%d")
+                if response.status_code == 200:
+                    result = response.json()
+                    properties = result.get('properties', {})
+                    columns = properties.get('columns', [])
+                    rows = properties.get('rows', [])
+                    
+                    # Dynamic Column Mapping to handle API variations
+                    col_map = {c['name']: i for i, c in enumerate(columns)}
+                    cost_idx = col_map.get('Cost', 0)
+                    res_idx = col_map.get('ResourceId', 1)
+                    # Currency handling - usually returned even if not grouped
+                    curr_idx = col_map.get('Currency') 
+                    if curr_idx is None: curr_idx = col_map.get('BillingCurrency')
+                    # Date handling (normalized in one pass after the loop)
+                    date_idx = col_map.get('UsageDate')
+                    
+                    for r in rows:
+                        out[0].append(r[date_idx] if date_idx is not None else end_date)
+                        out[1].append(r[res_idx])
+                        out[2].append(r[cost_idx])
+                        out[3].append(r[curr_idx] if curr_idx is not None else "USD") # Default fallback
+                    page_url = properties.get('nextLink')
+                elif response.status_code == 403:
+                    return out, "⚠️ Permission Denied: Your account does not have 'Cost Management Reader' access."
                 else:
-                    date_obj = pd.to_datetime(date_val)
-
-                cost_data.append({
-                    "Date": date_obj,
-                    "ResourceId": res_id,
-                    "ActualCost": cost_val,
-                    "OriginalCurrency": curr
-                })
-        elif response.status_code == 403:
-            error_msg = "⚠️ Permission Denied: Your account does not have 'Cost Management Reader' access."
-        else:
-            error_msg = f"Cost API Error: {response.status_code} - {response.text}"
+                    return out, f"Cost API Error: {response.status_code} - {response.text}"
+            return out, None
+        
+        # Smaller ResourceId filters stay under request limits and run in parallel
+        chunks = [resource_ids[k:k + COST_QUERY_CHUNK] for k in range(0, len(resource_ids), COST_QUERY_CHUNK)]
+        with ThreadPoolExecutor(max_workers=6) as ex:
+            for (d, r, c, cu), err in ex.map(query_chunk, chunks):
+                dates.extend(d); resids.extend(r); costs.extend(c); currs.extend(cu)
+                error_msg = error_msg or err
             
     except Exception as e:
         error_msg = f"Failed to fetch costs: {str(e)}"
+
+    if not costs:
+        return pd.DataFrame(), error_msg
+    df = pd.DataFrame({
+        'RawDate': pd.Series(dates, dtype=object),
+        'ResourceId': resids,
+        'ActualCost': np.asarray(costs, dtype=np.float64),
+        'OriginalCurrency': pd.Categorical(currs)
+    })
+
+    # UsageDate is normally an int like 20240131; anything else (ISO strings, the
+    # end_date fallback) goes through the generic parser
+    as_num = pd.to_numeric(df['RawDate'], errors='coerce')
+    dates = pd.to_datetime(as_num.astype('Int64').astype(str), format='%Y%m%d', errors='coerce')
+    missing = dates.isna()
+    if missing.any():
+        dates[missing] = pd.to_datetime(df.loc[missing, 'RawDate'], errors='coerce')
+    df.insert(0, 'Date', dates)
         
-    return pd.DataFrame(cost_data), error_msg
+    return df.drop(columns='RawDate'), error_msg
 
 def discover_resources_and_deployments(credential, subscription_id, resource_group=None, hub_name=None):
     """
     Finds OpenAI accounts, then drills down to find Deployments (Models) within them.
     """
+    from azure.mgmt.resource import ResourceManagementClient
+
     logs = []
     resource_client = ResourceManagementClient(credential, subscription_id)
 
@@ -227,41 +288,50 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
     found_accounts_list = []
     
     try:
+        logs.append(f"Scanning {f'RG {resource_group!r}' if resource_group else 'Subscription'} for OpenAI accounts...")
+        account_filter = "resourceType eq 'Microsoft.CognitiveServices/accounts'"
         if resource_group:
-            logs.append(f"Scanning RG '{resource_group}' for OpenAI accounts...")
             res_iter = resource_client.resources.list_by_resource_group(
-                resource_group_name=resource_group,
-                filter="resourceType eq 'Microsoft.CognitiveServices/accounts'"
+                resource_group_name=resource_group, filter=account_filter
             )
         else:
-            logs.append("Scanning Subscription for OpenAI accounts...")
-            res_iter = resource_client.resources.list(
-                filter="resourceType eq 'Microsoft.CognitiveServices/accounts'"
-            )
+            res_iter = resource_client.resources.list(filter=account_filter)
 
         for res in res_iter:
             # Check if it's actually OpenAI kind (or CogServices generic)
-            if hasattr(res, 'kind') and ('OpenAI' in res.kind or 'CognitiveServices' in res.kind):
-                # ID format: /subscriptions/{sub}/resourceGroups/{rg}/...
-                rg = res.id.split('/')[4]
-                found_accounts_list.append({
-                    "id": res.id,
-                    "name": res.name,
-                    "group": rg
-                })
+            kind = getattr(res, 'kind', None) or ''
+            if 'OpenAI' not in kind and 'CognitiveServices' not in kind:
+                continue
+            # ID format: /subscriptions/{sub}/resourceGroups/{rg}/...
+            found_accounts_list.append({
+                "id": res.id,
+                "name": res.name,
+                "group": res.id.split('/')[4]
+            })
     except Exception as e:
         logs.append(f"Error scanning resources: {e}")
 
     # 2. Drill down into Deployments per Account
     final_inventory = []
+    deployments_by_id = {}
     
-    # Show progress bar if we have many accounts
+    # Lookups are independent GETs: fan them out with one token, and show progress as they finish
     if found_accounts_list:
         pbar = st.progress(0)
+        token = get_mgmt_token(credential)
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            futures = {
+                ex.submit(get_deployments, token, subscription_id, a['group'], a['name']): a
+                for a in found_accounts_list
+            }
+            for i, fut in enumerate(as_completed(futures)):
+                deployments_by_id[futures[fut]['id']] = fut.result()
+                pbar.progress((i + 1) / len(found_accounts_list))
+        pbar.empty()
         
-    for i, acct in enumerate(found_accounts_list):
+    for acct in found_accounts_list:
         logs.append(f"Inspecting account: {acct['name']}")
-        depts = get_deployments(credential, subscription_id, acct['group'], acct['name'])
+        depts = deployments_by_id[acct['id']]
         
         if not depts:
             # If no deployments found, add a "General" placeholder
@@ -290,20 +360,23 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
                     "model_name": d['model_name'],
                     "type": m_type
                 })
-        
-        if found_accounts_list:
-            pbar.progress((i + 1) / len(found_accounts_list))
-            
-    if found_accounts_list:
-        pbar.empty()
                 
     return final_inventory, logs
 
-def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
+@st.cache_resource
+def get_monitor_client(_credential, subscription_id):
+    """One MonitorManagementClient per subscription, imported and built on first use."""
+    from azure.mgmt.monitor import MonitorManagementClient
+    return MonitorManagementClient(_credential, subscription_id)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_detailed_metrics(_credential, subscription_id, inventory_list, days=7):
     """
     Fetches usage metrics filtered by Deployment Name to get per-model granularity.
     """
-    client = MonitorManagementClient(credential, subscription_id)
+    from azure.core.exceptions import HttpResponseError
+
+    client = get_monitor_client(_credential, subscription_id)
     
     # Metrics: 'GeneratedImages' (DALL-E), 'ProcessedPromptTokens'/'GeneratedTokens' (Text)
     metric_names = "ProcessedPromptTokens,GeneratedTokens,GeneratedImages"
@@ -312,8 +385,8 @@ def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
     starttime = endtime - timedelta(days=days)
     timespan = f"{starttime.isoformat()}/{endtime.isoformat()}"
 
-    data_rows = []
     errors = []
+    label_cols = ("Account", "Deployment", "Model", "Type", "Metric")
     
     # Group by Account ID to minimize client calls
     grouped_inventory = {}
@@ -322,56 +395,129 @@ def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
             grouped_inventory[item['id']] = []
         grouped_inventory[item['id']].append(item)
 
-    progress_bar = st.progress(0)
-    total_steps = len(grouped_inventory)
-    current_step = 0
-
-    for account_id, deployments in grouped_inventory.items():
-        try:
-            for dept in deployments:
-                dept_name = dept['deployment_name']
-                is_agg = dept_name == "All Models (Aggregated)"
-                
-                # Filter syntax for Azure Monitor
-                odata_filter = f"ModelDeploymentName eq '{dept_name}'" if not is_agg else None
-                
+    def fetch_account(account_id, deployments):
+        # One call per account: Monitor splits the series by deployment server-side, and each
+        # series is matched back to its inventory entry through this lookup
+        named = {d['deployment_name'].lower(): d for d in deployments if d['deployment_name'] != "All Models (Aggregated)"}
+        query = dict(
+            resource_uri=account_id,
+            timespan=timespan,
+            interval="PT1H",
+            metricnames=metric_names,
+            aggregation="Total"
+        )
+        split = bool(named)
+        if split:
+            try:
+                # Split queries return only 10 series by default; ask for one per deployment
                 metrics_data = client.metrics.list(
-                    resource_uri=account_id,
-                    timespan=timespan,
-                    interval="PT1H",
-                    metricnames=metric_names,
-                    aggregation="Total",
-                    filter=odata_filter 
+                    **query, filter="ModelDeploymentName eq '*'",
+                    top=max(10, len(named)), orderby="Total desc"
                 )
-                
-                for item in metrics_data.value:
-                    metric_name = item.name.value
-                    for timeseries in item.timeseries:
-                        for data in timeseries.data:
-                            if data.total and data.total > 0:
-                                data_rows.append({
-                                    "TimeStamp": data.time_stamp,
-                                    "Account": dept['name'],
-                                    "Deployment": dept_name,
-                                    "Model": dept['model_name'],
-                                    "Type": dept['type'],
-                                    "Metric": metric_name,
-                                    "Value": data.total
-                                })
-
-        except Exception as e:
-            if "BadRequest" not in str(e): 
-                errors.append(f"Error {account_id.split('/')[-1]}: {str(e)}")
-        
-        current_step += 1
-        progress_bar.progress(current_step / total_steps)
+            except HttpResponseError as e:
+                if e.status_code != 400:
+                    raise
+                # Accounts without the dimension reject the split; fall back to the account total
+                split = False
+                metrics_data = client.metrics.list(**query)
+        else:
+            metrics_data = client.metrics.list(**query)
         
-    progress_bar.empty()
-    return pd.DataFrame(data_rows), errors
-
+        # Resolve each series to its label tuple first, so the point buffers can be sized exactly
+        series = []
+        notes = []
+        dropped = 0
+        for item in metrics_data.value:
+            metric_name = item.name.value
+            for timeseries in item.timeseries:
+                tag = None
+                for md in (timeseries.metadatavalues or []):
+                    if md.name.value.lower() == "modeldeploymentname" and md.value:
+                        tag = str(md.value).lower()
+                dept = named.get(tag) if tag else None
+                if dept is None:
+                    if tag:
+                        # Tagged with a deployment outside the inventory (deleted/renamed): never re-attribute it
+                        dropped += 1
+                        continue
+                    if len(deployments) == 1:
+                        dept = deployments[0]
+                    elif not split:
+                        # Unsplit total of a multi-deployment account: keep it as an account-level row
+                        m_type = "image" if metric_name == "GeneratedImages" else "text"
+                        labels = (deployments[0]['name'], "All Models (Aggregated)", "unknown", m_type, metric_name)
+                        series.append((labels, timeseries.data or []))
+                        continue
+                    else:
+                        dropped += 1
+                        continue
+                labels = (dept['name'], dept['deployment_name'], dept['model_name'], dept['type'], metric_name)
+                series.append((labels, timeseries.data or []))
+        if not split and len(deployments) > 1:
+            notes.append(f"Error {account_id.split('/')[-1]}: deployment split unavailable, showing account totals")
+        if dropped:
+            notes.append(f"Error {account_id.split('/')[-1]}: {dropped} series had no matching deployment and were skipped")
+
+        # Pre-sized buffers filled in one pass; each kept point records its series index
+        n_max = sum(len(data) for _, data in series)
+        ts_out = np.empty(n_max, dtype=object)
+        val_out = np.empty(n_max, dtype=np.float64)
+        series_out = np.empty(n_max, dtype=np.int32)
+        k = 0
+        for i, (_, data) in enumerate(series):
+            for point in data:
+                if point.total and point.total > 0:
+                    ts_out[k] = point.time_stamp
+                    val_out[k] = point.total
+                    series_out[k] = i
+                    k += 1
+        return [labels for labels, _ in series], ts_out[:k], val_out[:k], series_out[:k], notes
+
+    results = {}
+
+    if grouped_inventory:
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            futures = {ex.submit(fetch_account, account_id, deps): account_id for account_id, deps in grouped_inventory.items()}
+            for fut in as_completed(futures):
+                account_id = futures[fut]
+                try:
+                    results[account_id] = fut.result()
+                except Exception as e:
+                    if "BadRequest" not in str(e): 
+                        errors.append(f"Error {account_id.split('/')[-1]}: {str(e)}")
+
+    # Stitch accounts in inventory order, offsetting series indices into one label table
+    series_labels, ts_parts, val_parts, idx_parts = [], [], [], []
+    for account_id in grouped_inventory:
+        if account_id in results:
+            labels, ts_arr, val_arr, idx_arr, notes = results[account_id]
+            errors.extend(notes)
+            idx_parts.append(idx_arr + len(series_labels))
+            series_labels.extend(labels)
+            ts_parts.append(ts_arr)
+            val_parts.append(val_arr)
+    series_idx = np.concatenate(idx_parts) if idx_parts else np.empty(0, dtype=np.int32)
+
+    # Labels are factorized per series (a handful of rows), then expanded by code
+    label_frame = {}
+    for j, key in enumerate(label_cols):
+        codes, cats = pd.factorize(pd.Series([labels[j] for labels in series_labels], dtype=object))
+        label_frame[key] = pd.Categorical.from_codes(codes[series_idx], cats)
+
+    df = pd.DataFrame({
+        "TimeStamp": pd.to_datetime(np.concatenate(ts_parts) if ts_parts else []),
+        **label_frame,
+        "Value": np.concatenate(val_parts) if val_parts else np.empty(0)
+    })
+    return df, errors
+
+@st.cache_data
 def generate_demo_data_detailed(days=7):
+    rng = np.random.default_rng()
     dates = pd.date_range(end=datetime.now(), periods=days*24, freq='H')
-    data = []
+    n = len(dates)
+    busy = (dates.hour >= 9) & (dates.hour <= 17)
+    hour_mod = np.where(busy, 10, 1)
     
     models = [
         {"name": "gpt-4", "type": "text", "dept": "gpt-4-deployment"},
@@ -380,41 +526,136 @@ def generate_demo_data_detailed(days=7):
         {"name": "dall-e-3", "type": "image", "dept": "img-gen"}
     ]
     
-    for date in dates:
-        hour_mod = 10 if 9 <= date.hour <= 17 else 1
-        
-        for m in models:
-            if m['type'] == 'image':
-                val = int(random.random() * 5 * hour_mod) if hour_mod > 1 else 0
-                if val > 0:
-                    data.append({"TimeStamp": date, "Model": m['name'], "Type": "image", "Metric": "GeneratedImages", "Value": val, "Deployment": m['dept']})
-            else:
-                prompts = int(random.gauss(500, 100) * hour_mod)
-                gens = int(random.gauss(200, 50) * hour_mod)
-                if prompts > 0:
-                    data.append({"TimeStamp": date, "Model": m['name'], "Type": m['type'], "Metric": "ProcessedPromptTokens", "Value": prompts, "Deployment": m['dept']})
-                    data.append({"TimeStamp": date, "Model": m['name'], "Type": m['type'], "Metric": "GeneratedTokens", "Value": gens, "Deployment": m['dept']})
+    # One batch of draws per model over all hours, built as columnar frames
+    frames = []
+    for m in models:
+        if m['type'] == 'image':
+            imgs = (rng.random(n) * 5 * hour_mod).astype(int) * busy
+            keep = imgs > 0
+            frames.append(pd.DataFrame({"TimeStamp": dates[keep], "Model": m['name'], "Type": "image", "Metric": "GeneratedImages", "Value": imgs[keep], "Deployment": m['dept']}))
+        else:
+            prompts = (rng.normal(500, 100, n) * hour_mod).astype(int)
+            gens = (rng.normal(200, 50, n) * hour_mod).astype(int)
+            keep = prompts > 0
+            frames.append(pd.DataFrame({"TimeStamp": dates[keep], "Model": m['name'], "Type": m['type'], "Metric": "ProcessedPromptTokens", "Value": prompts[keep], "Deployment": m['dept']}))
+            frames.append(pd.DataFrame({"TimeStamp": dates[keep], "Model": m['name'], "Type": m['type'], "Metric": "GeneratedTokens", "Value": gens[keep], "Deployment": m['dept']}))
     
-    # Fake Cost Data for Demo (SEK)
-    cost_data = []
-    unique_days = sorted(list(set([d.date() for d in dates])))
-    for d in unique_days:
-        # Resource 1: Main GPT-4
-        cost_data.append({
-            "Date": pd.to_datetime(d),
-            "ActualCost": random.uniform(100, 300),
+    # Fake Cost Data for Demo (SEK): Main GPT-4 and DALL-E resources
+    unique_days = pd.to_datetime(pd.Index(dates.date).unique())
+    n_days = len(unique_days)
+    df_cost = pd.concat([
+        pd.DataFrame({
+            "Date": unique_days,
+            "ActualCost": rng.uniform(100, 300, n_days),
             "OriginalCurrency": "SEK",
             "ResourceId": "/subscriptions/xxx/resourceGroups/demo-rg/providers/Microsoft.CognitiveServices/accounts/gpt-4-production"
-        })
-        # Resource 2: DALL-E
-        cost_data.append({
-            "Date": pd.to_datetime(d),
-            "ActualCost": random.uniform(20, 80),
+        }),
+        pd.DataFrame({
+            "Date": unique_days,
+            "ActualCost": rng.uniform(20, 80, n_days),
             "OriginalCurrency": "SEK",
             "ResourceId": "/subscriptions/xxx/resourceGroups/demo-rg/providers/Microsoft.CognitiveServices/accounts/dall-e-lab"
         })
+    ], ignore_index=True)
                     
-    return pd.DataFrame(data), pd.DataFrame(cost_data)
+    return pd.concat(frames, ignore_index=True), df_cost
+
+def _downcast(df, dtypes):
+    """
+    Shrinks measure columns in place. Whole-number columns past float32's exact
+    integer range (2**24, e.g. large token counts) go to int32 instead, or stay 64-bit if even that overflows.
+    """
+    for c, dtype in dtypes.items():
+        if c not in df:
+            continue
+        v = df[c].to_numpy()
+        peak = np.abs(v).max(initial=0)
+        if peak < 2**24:
+            df[c] = v.astype(dtype)
+        elif peak < 2**31 and np.all(np.mod(v, 1) == 0):
+            df[c] = v.astype(np.int32)
+
+def token_identity(credential):
+    """Tenant/object id of the signed-in identity, so disk snapshots are never shared across users."""
+    try:
+        payload = get_mgmt_token(credential).split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return f"{claims['tid']}/{claims['oid']}"
+    except Exception:
+        # Opaque token: key on this process's credential, which simply misses across restarts
+        return f"process-{id(credential)}"
+
+def disk_cached(kind, key, fetch, refresh=False):
+    """
+    Returns (df, errors, age_seconds) from a fresh Parquet snapshot for this key, or runs
+    fetch() -> (df, errors) and snapshots the result when it came back clean (age is None then).
+    refresh=True skips the snapshot and rewrites it from the live result.
+    """
+    path = CACHE_DIR / f"{kind}-{hashlib.sha1(key.encode()).hexdigest()}.parquet"
+    if not refresh:
+        try:
+            age = time.time() - path.stat().st_mtime
+            if age < DISK_CACHE_MAX_AGE:
+                return pd.read_parquet(path), None, age
+        except Exception:
+            pass  # Missing or unreadable snapshot: fall through to the API
+
+    df, errs = fetch()
+    if not errs and not df.empty:
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            df.to_parquet(path, compression="zstd")
+        except Exception as e:
+            print(f"Disk cache write failed: {e}")
+    return df, errs, None
+
+# --- CHART BUILDERS ---
+# Figures are memoized as Plotly JSON keyed on their (already aggregated) input frame,
+# so reruns from unrelated widgets (region, USD rate) skip the Python-side trace construction.
+# Plotly is imported inside each builder so it only loads on a cache miss.
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_model_bar(df_model):
+    import plotly.express as px
+    return px.bar(df_model, x="Model", y="Carbon_g", color="Model", title="Total Carbon (gCO2e)", text_auto='.1f').to_json()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_token_area(df_text):
+    import plotly.express as px
+    return px.area(df_text, x="TimeStamp", y="Value", color="Metric", title="Token Volume").to_json()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_images_bar(df_img):
+    import plotly.express as px
+    return px.bar(df_img, x="TimeStamp", y="Value", title="Images Created").to_json()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_cost_trend(df_cost_plot):
+    import plotly.express as px
+    fig = px.bar(
+        df_cost_plot, 
+        x="Date", 
+        y="CostSEK", 
+        color="ResourceName",
+        title="Daily Cost Trend by Resource",
+        labels={"CostSEK": "Cost (SEK)", "Date": "Billing Date"},
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    fig.update_layout(hovermode="x unified")
+    return fig.to_json()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_cost_share(df_share):
+    import plotly.express as px
+    fig = px.pie(
+        df_share, 
+        values="CostSEK", 
+        names="ResourceName", 
+        title="Cost Distribution",
+        hole=0.4,
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    return fig.to_json()
 
 # --- UI LAYOUT ---
 
@@ -441,6 +682,7 @@ with st.sidebar:
         days_to_fetch = st.slider("Days history", 1, 30, 7)
         show_debug = st.checkbox("Show Debug Logs")
         fetch_btn = st.button("Discover & Analyze")
+        refresh_btn = st.button("🔄 Refresh (skip cache)")
         
     elif mode == "Manual Input":
         sub_id = st.text_input("Subscription ID", type="password")
@@ -448,19 +690,27 @@ with st.sidebar:
         res_name = st.text_input("OpenAI Resource Name")
         days_to_fetch = st.slider("Days history", 1, 30, 7)
         fetch_btn = st.button("Fetch Data")
+        refresh_btn = st.button("🔄 Refresh (skip cache)")
         show_debug = False
     else:
         fetch_btn = True
+        refresh_btn = False
         days_to_fetch = 7
         sub_id = ""
         show_debug = False
 
-if fetch_btn:
+if refresh_btn:
+    # Live fetch: drop the in-memory results too, then the disk snapshots are rewritten below
+    fetch_detailed_metrics.clear()
+    fetch_actual_costs.clear()
+
+if fetch_btn or refresh_btn:
     df_raw = pd.DataFrame()
     df_cost = pd.DataFrame()
     debug_logs = []
     errors = []
     cost_error = None
+    metrics_age = cost_age = None
     
     if mode == "Demo Data":
         df_raw, df_cost = generate_demo_data_detailed(days_to_fetch)
@@ -480,15 +730,27 @@ if fetch_btn:
                         st.dataframe(pd.DataFrame(inventory)[['name', 'deployment_name', 'model_name', 'type']])
                     
                     # 1. Fetch Carbon/Usage Metrics
+                    identity = token_identity(credential)
                     with st.spinner("📊 Fetching usage metrics..."):
-                        df_raw, errors = fetch_detailed_metrics(credential, sub_id, inventory, days_to_fetch)
+                        metrics_key = json.dumps([identity, sub_id, sorted(json.dumps(i, sort_keys=True) for i in inventory), days_to_fetch])
+                        df_raw, errors, metrics_age = disk_cached(
+                            "metrics", metrics_key,
+                            lambda: fetch_detailed_metrics(credential, sub_id, inventory, days_to_fetch),
+                            refresh=refresh_btn
+                        )
+                        errors = errors or []
                         
                     # 2. Fetch Cost Data
                     with st.spinner("💰 Fetching billing data..."):
                         # Get unique Resource IDs to query cost API
-                        unique_res_ids = list(set([item['id'] for item in inventory]))
+                        # Sorted so the cost cache key doesn't depend on inventory order
+                        unique_res_ids = sorted(set(item['id'] for item in inventory))
                         if unique_res_ids:
-                            df_cost, cost_error = fetch_actual_costs(credential, sub_id, unique_res_ids, days_to_fetch)
+                            df_cost, cost_error, cost_age = disk_cached(
+                                "cost", json.dumps([identity, sub_id, unique_res_ids, days_to_fetch]),
+                                lambda: fetch_actual_costs(credential, sub_id, unique_res_ids, days_to_fetch),
+                                refresh=refresh_btn
+                            )
                 else:
                     st.warning("No OpenAI resources found.")
 
@@ -497,8 +759,19 @@ if fetch_btn:
             credential = get_azure_credentials()
             inv = [{"id": f"/subscriptions/{sub_id}/resourceGroups/{rg_name}/providers/Microsoft.CognitiveServices/accounts/{res_name}", 
                     "name": res_name, "deployment_name": "All Models (Aggregated)", "model_name": "Manual", "type": "text"}]
-            df_raw, errors = fetch_detailed_metrics(credential, sub_id, inv, days_to_fetch)
-            df_cost, cost_error = fetch_actual_costs(credential, sub_id, [inv[0]['id']], days_to_fetch)
+            identity = token_identity(credential)
+            with st.spinner("📊 Fetching usage metrics & billing data..."):
+                df_raw, errors, metrics_age = disk_cached(
+                    "metrics", json.dumps([identity, sub_id, inv[0]['id'], days_to_fetch]),
+                    lambda: fetch_detailed_metrics(credential, sub_id, inv, days_to_fetch),
+                    refresh=refresh_btn
+                )
+                errors = errors or []
+                df_cost, cost_error, cost_age = disk_cached(
+                    "cost", json.dumps([identity, sub_id, [inv[0]['id']], days_to_fetch]),
+                    lambda: fetch_actual_costs(credential, sub_id, [inv[0]['id']], days_to_fetch),
+                    refresh=refresh_btn
+                )
 
     # --- PROCESSING & VISUALIZATION ---
     if show_debug and (debug_logs or errors):
@@ -507,20 +780,32 @@ if fetch_btn:
             for e in errors: st.error(e)
             if cost_error: st.warning(cost_error)
 
+    cached_ages = [f"{label} {age / 60:.0f} min old" for label, age in (("usage metrics", metrics_age), ("billing", cost_age)) if age is not None]
+    if cached_ages:
+        st.info(f"💾 Showing saved snapshots ({', '.join(cached_ages)}). Press **Refresh (skip cache)** to fetch live data.")
+
     if not df_raw.empty:
-        # 1. Carbon Calculations
-        def calc_kwh(row):
-            factor = CARBON_FACTORS.get("standard_text", 0.0004)
-            if row['Type'] == 'image':
-                return row['Value'] * CARBON_FACTORS['image_gen']
-            elif row['Type'] == 'reasoning':
-                factor = CARBON_FACTORS['reasoning_text']
-            elif row['Type'] == 'embedding':
-                factor = CARBON_FACTORS['embedding']
-            return (row['Value'] / 1000) * factor
-
-        df_raw['kWh'] = df_raw.apply(calc_kwh, axis=1)
-        df_raw['Carbon_g'] = df_raw['kWh'] * grid_intensity
+        # 0. Repeated labels as categoricals (demo data has no Account column)
+        for c in ['Type', 'Metric', 'Model', 'Account', 'Deployment']:
+            if c in df_raw:
+                df_raw[c] = df_raw[c].astype('category')
+        _downcast(df_raw, {'Value': 'float32'})
+
+        # 1. Carbon Calculations (images are per unit, everything else per 1k tokens)
+        # kWh per unit of Value gathered from a small table by Type code; unknown types get
+        # code -1, which indexes the trailing standard_text entry
+        kwh_per_unit = np.array([
+            CARBON_FACTORS['standard_text'] / 1000,
+            CARBON_FACTORS['image_gen'],
+            CARBON_FACTORS['reasoning_text'] / 1000,
+            CARBON_FACTORS['embedding'] / 1000,
+            CARBON_FACTORS['standard_text'] / 1000
+        ])
+        type_code = pd.Categorical(df_raw['Type'], categories=['text', 'image', 'reasoning', 'embedding']).codes
+        unit_kwh = kwh_per_unit[type_code]
+        df_raw['kWh'] = df_raw['Value'].to_numpy() * unit_kwh
+        df_raw['Carbon_g'] = df_raw['kWh'].to_numpy() * grid_intensity
+        _downcast(df_raw, {'kWh': 'float32', 'Carbon_g': 'float32'})
         
         total_co2 = df_raw['Carbon_g'].sum()
         total_kwh = df_raw['kWh'].sum()
@@ -530,22 +815,19 @@ if fetch_btn:
         total_cost_sek = 0.0
         
         if not df_cost.empty:
-            # Helper to convert specific row currency to SEK
-            def convert_to_sek(row):
-                curr = row['OriginalCurrency']
-                val = row['ActualCost']
-                
-                if curr == "SEK":
-                    return val
-                elif curr == "USD":
-                    return val * usd_rate
-                elif curr == "EUR":
-                    return val * EXCHANGE_RATES_TO_SEK.get("EUR", 11.5)
-                else:
-                    # Fallback using dict or 1.0
-                    return val * EXCHANGE_RATES_TO_SEK.get(curr, 1.0)
-            
-            df_cost['CostSEK'] = df_cost.apply(convert_to_sek, axis=1)
+            # Per-currency rate gathered by category code (sidebar USD override, unknown currencies
+            # and missing values at 1.0 via the trailing entry)
+            df_cost['OriginalCurrency'] = df_cost['OriginalCurrency'].astype('category')
+            rate_map = {**EXCHANGE_RATES_TO_SEK, "SEK": 1.0, "USD": usd_rate}
+            currency = df_cost['OriginalCurrency'].cat
+            rate_table = np.array([rate_map.get(c, 1.0) for c in currency.categories] + [1.0])
+            df_cost['CostSEK'] = df_cost['ActualCost'].to_numpy() * rate_table[currency.codes.to_numpy()]
+            # Short resource name for charts/ledger: IDs repeat per day, so split each unique ID once
+            df_cost['ResourceId'] = df_cost['ResourceId'].astype('category')
+            id_cats = df_cost['ResourceId'].cat.categories
+            short_names = dict(zip(id_cats, id_cats.str.rsplit('/', n=1).str[-1]))
+            df_cost['ResourceName'] = df_cost['ResourceId'].map(short_names).astype(object).fillna('Unknown').astype('category')
+            _downcast(df_cost, {'ActualCost': 'float32', 'CostSEK': 'float32'})
             total_cost_sek = df_cost['CostSEK'].sum()
         
         # KPI Row
@@ -558,16 +840,18 @@ if fetch_btn:
         st.markdown("---")
         
         # 3. TABS
+        import plotly.graph_objects as go  # only loaded once there is data to chart
         tab_models, tab_features, tab_cost, tab_data = st.tabs(["🤖 Emissions by Model", "🎨 Features", "💰 Cost Analysis", "📄 Data"])
         
         with tab_models:
             st.subheader("Which model is the heaviest emitter?")
-            df_model = df_raw.groupby("Model")[["Carbon_g", "Value"]].sum().reset_index()
-            df_model = df_model.sort_values("Carbon_g", ascending=False)
+            df_model = df_raw.groupby("Model", observed=True, sort=False, as_index=False).agg(
+                Carbon_g=("Carbon_g", "sum"), Value=("Value", "sum")
+            ).sort_values("Carbon_g", ascending=False)
             
             col_chart, col_details = st.columns([2, 1])
             with col_chart:
-                fig_bar = px.bar(df_model, x="Model", y="Carbon_g", color="Model", title="Total Carbon (gCO2e)", text_auto='.1f')
+                fig_bar = go.Figure(json.loads(build_model_bar(df_model)))
                 st.plotly_chart(fig_bar, use_container_width=True)
             with col_details:
                 st.write("**Breakdown:**")
@@ -581,28 +865,23 @@ if fetch_btn:
             with c_a:
                 st.markdown("#### 📝 Text Usage")
                 if not df_text.empty:
-                    fig_text = px.area(df_text, x="TimeStamp", y="Value", color="Metric", title="Token Volume")
+                    fig_text = go.Figure(json.loads(build_token_area(df_text[['TimeStamp', 'Value', 'Metric']])))
                     st.plotly_chart(fig_text, use_container_width=True)
                 else: st.info("No text usage.")
             with c_b:
                 st.markdown("#### 🖼️ Image Generation")
                 if not df_img.empty:
-                    fig_img = px.bar(df_img, x="TimeStamp", y="Value", title="Images Created")
+                    fig_img = go.Figure(json.loads(build_images_bar(df_img[['TimeStamp', 'Value']])))
                     st.plotly_chart(fig_img, use_container_width=True)
                 else: st.info("No image data.")
 
         with tab_cost:
             st.subheader("Billing Analysis (SEK)")
             if not df_cost.empty:
-                # 1. Prepare Data for Viz
-                # Extract simple name from ResourceId
-                df_cost['ResourceName'] = df_cost['ResourceId'].apply(lambda x: x.split('/')[-1] if isinstance(x, str) else 'Unknown')
-                
-                # 2. KPIs
+                # 1. KPIs
                 total_c = df_cost['CostSEK'].sum()
                 # Avg per day (sum all resources for that day, then mean)
-                daily_sums = df_cost.groupby('Date')['CostSEK'].sum()
-                avg_c = daily_sums.mean()
+                avg_c = df_cost.groupby('Date', observed=True, sort=False)['CostSEK'].sum().mean()
                 
                 m1, m2, m3 = st.columns(3)
                 m1.metric("Total Period Spend", f"{total_c:,.2f} kr", delta="Aggregated")
@@ -611,37 +890,23 @@ if fetch_btn:
                 
                 st.markdown("---")
                 
-                # 3. Charts
+                # 2. Charts
                 c1, c2 = st.columns([2, 1])
                 
                 with c1:
                     # Stacked Bar Chart by Resource
-                    fig_trend = px.bar(
-                        df_cost, 
-                        x="Date", 
-                        y="CostSEK", 
-                        color="ResourceName",
-                        title="Daily Cost Trend by Resource",
-                        labels={"CostSEK": "Cost (SEK)", "Date": "Billing Date"},
-                        color_discrete_sequence=px.colors.qualitative.Pastel
-                    )
-                    fig_trend.update_layout(hovermode="x unified")
+                    fig_trend = go.Figure(json.loads(build_cost_trend(df_cost[['Date', 'CostSEK', 'ResourceName']])))
                     st.plotly_chart(fig_trend, use_container_width=True)
                 
                 with c2:
                     # Donut Chart for Share
-                    df_share = df_cost.groupby("ResourceName")["CostSEK"].sum().reset_index()
-                    fig_pie = px.pie(
-                        df_share, 
-                        values="CostSEK", 
-                        names="ResourceName", 
-                        title="Cost Distribution",
-                        hole=0.4,
-                        color_discrete_sequence=px.colors.qualitative.Pastel
+                    df_share = df_cost.groupby("ResourceName", observed=True, sort=False, as_index=False).agg(
+                        CostSEK=("CostSEK", "sum")
                     )
+                    fig_pie = go.Figure(json.loads(build_cost_share(df_share)))
                     st.plotly_chart(fig_pie, use_container_width=True)
 
-                # 4. Detailed Table
+                # 3. Detailed Table
                 st.markdown("#### Detailed Ledger")
                 st.dataframe(
                     df_cost[['Date', 'ResourceName', 'CostSEK', 'ActualCost', 'OriginalCurrency']].sort_values("Date", ascending=False),
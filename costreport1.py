@@ -1,13 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 import requests
+import threading
+import functools
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-from azure.mgmt.monitor import MonitorManagementClient
-from azure.mgmt.resource import ResourceManagementClient
 # REMOVED: from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
-import random
 
 # Page Configuration
 st.set_page_config(
@@ -56,12 +60,51 @@ CARBON_FACTORS = {
 # Tree Absorption: ~21kg CO2 per year = ~57.5g per day
 GRAMS_CO2_PER_TREE_DAY = 57.5
 
+# Model-name substrings -> carbon type, checked in order; anything else is "text"
+_TYPE_PATTERNS = [("dall", "image"), ("o1", "reasoning"), ("reasoning", "reasoning"), ("embedding", "embedding")]
+
+@functools.lru_cache(maxsize=256)
+def classify(model_name):
+    """Carbon type for a model name (image/reasoning/embedding/text)."""
+    ml = model_name.lower()
+    return next((t for k, t in _TYPE_PATTERNS if k in ml), "text")
+
+@st.cache_resource
+def get_session():
+    """Keep-alive session shared across reruns so management.azure.com connections are reused."""
+    s = requests.Session()
+    s.mount('https://', HTTPAdapter(
+        pool_connections=32, pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    ))
+    return s
+
+# Resolved once per run on the main thread; worker threads use this handle
+_SESSION = get_session()
+
+@st.cache_resource
+def _token_store():
+    """Bearer tokens per credential, shared across reruns."""
+    return {"lock": threading.Lock(), "tokens": {}}
+
+def _get_mgmt_token(credential):
+    """Returns a management.azure.com bearer string, refreshed only within 5 minutes of expiry."""
+    store = _token_store()
+    with store["lock"]:
+        token = store["tokens"].get(id(credential))
+        if token is None or time.time() > token.expires_on - 300:
+            token = credential.get_token("https://management.azure.com/.default")
+            store["tokens"][id(credential)] = token
+        return token.token
+
 @st.cache_resource
 def get_azure_credentials():
     """Authenticates using Default or Interactive credentials."""
+    # Azure SDK imports are deferred so Demo mode never loads them
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
     try:
         credential = DefaultAzureCredential()
-        credential.get_token("https://management.azure.com/.default")
+        _get_mgmt_token(credential)
         return credential
     except Exception as e:
         print(f"DefaultAuth failed: {e}")
@@ -71,26 +114,33 @@ def get_azure_credentials():
             st.error(f"Authentication failed: {e2}")
             return None
 
-def get_deployments(credential, subscription_id, resource_group, account_name):
+def progress_every(total, max_updates=20):
+    """Completions between progress-bar ticks, so a fan-out sends at most ~max_updates to the browser."""
+    return max(1, total // max_updates)
+
+def get_deployments(token, subscription_id, resource_group, account_name):
     """
     Fetches the list of deployments (models) for a specific OpenAI account.
     Uses direct REST API to avoid needing the extra azure-mgmt-cognitiveservices library.
     """
     deployments = []
     try:
-        # Get Auth Token
-        token = credential.get_token("https://management.azure.com/.default").token
         headers = {"Authorization": f"Bearer {token}"}
         
         # Azure Management API for Deployments
         api_version = "2023-05-01"
         url = f"https://management.azure.com/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{account_name}/deployments?api-version={api_version}"
         
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            items = response.json().get('value', [])
-            for item in items:
+        # Follow nextLink so accounts with many deployments aren't truncated to the first page
+        while url:
+            response = _SESSION.get(url, headers=headers, timeout=10)
+            
+            if response.status_code != 200:
+                print(f"Failed to list deployments for {account_name}: {response.status_code}")
+                break
+
+            page = response.json()
+            for item in page.get('value', []):
                 # Parse properties safely
                 props = item.get('properties', {})
                 model_info = props.get('model', {})
@@ -101,60 +151,72 @@ def get_deployments(credential, subscription_id, resource_group, account_name):
                     "model_version": model_info.get('version', ''),
                     "model_format": model_info.get('format', '')
                 })
-        else:
-            print(f"Failed to list deployments for {account_name}: {response.status_code}")
+            url = page.get('nextLink')
             
     except Exception as e:
         print(f"Error listing deployments: {e}")
         
     return deployments
 
-def discover_resources_and_deployments(credential, subscription_id, resource_group=None, hub_name=None):
+@st.cache_data(ttl=300, show_spinner=False)
+def discover_resources_and_deployments(_credential, subscription_id, resource_group=None, hub_name=None):
     """
     Finds OpenAI accounts, then drills down to find Deployments (Models) within them.
     """
+    from azure.mgmt.resource import ResourceManagementClient
+
     logs = []
-    resource_client = ResourceManagementClient(credential, subscription_id)
+    resource_client = ResourceManagementClient(_credential, subscription_id)
 
     # 1. Find Accounts (Hub or RG or Subscription)
     found_accounts_list = []
     
     try:
+        logs.append(f"Scanning {f'RG {resource_group!r}' if resource_group else 'Subscription'} for OpenAI accounts...")
+        account_filter = "resourceType eq 'Microsoft.CognitiveServices/accounts'"
         if resource_group:
-            logs.append(f"Scanning RG '{resource_group}' for OpenAI accounts...")
             res_iter = resource_client.resources.list_by_resource_group(
-                resource_group_name=resource_group,
-                filter="resourceType eq 'Microsoft.CognitiveServices/accounts'"
+                resource_group_name=resource_group, filter=account_filter
             )
         else:
-            logs.append("Scanning Subscription for OpenAI accounts...")
-            res_iter = resource_client.resources.list(
-                filter="resourceType eq 'Microsoft.CognitiveServices/accounts'"
-            )
+            res_iter = resource_client.resources.list(filter=account_filter)
 
         for res in res_iter:
             # Check if it's actually OpenAI kind (or CogServices generic)
-            if hasattr(res, 'kind') and ('OpenAI' in res.kind or 'CognitiveServices' in res.kind):
-                # ID format: /subscriptions/{sub}/resourceGroups/{rg}/...
-                rg = res.id.split('/')[4]
-                found_accounts_list.append({
-                    "id": res.id,
-                    "name": res.name,
-                    "group": rg
-                })
+            kind = getattr(res, 'kind', None) or ''
+            if 'OpenAI' not in kind and 'CognitiveServices' not in kind:
+                continue
+            # ID format: /subscriptions/{sub}/resourceGroups/{rg}/...
+            found_accounts_list.append({
+                "id": res.id,
+                "name": res.name,
+                "group": res.id.split('/')[4]
+            })
     except Exception as e:
         logs.append(f"Error scanning resources: {e}")
 
     # 2. Drill down into Deployments per Account
     final_inventory = []
+    deployments_by_id = {}
     
-    # Show progress bar if we have many accounts
+    # Lookups are independent GETs: fan them out with one token, and show progress as they finish
     if found_accounts_list:
         pbar = st.progress(0)
+        token = _get_mgmt_token(_credential)
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            futures = {
+                ex.submit(get_deployments, token, subscription_id, a['group'], a['name']): a
+                for a in found_accounts_list
+            }
+            for i, fut in enumerate(as_completed(futures)):
+                deployments_by_id[futures[fut]['id']] = fut.result()
+                if (i + 1) % progress_every(len(found_accounts_list)) == 0 or i + 1 == len(found_accounts_list):
+                    pbar.progress((i + 1) / len(found_accounts_list))
+        pbar.empty()
         
-    for i, acct in enumerate(found_accounts_list):
+    for acct in found_accounts_list:
         logs.append(f"Inspecting account: {acct['name']}")
-        depts = get_deployments(credential, subscription_id, acct['group'], acct['name'])
+        depts = deployments_by_id[acct['id']]
         
         if not depts:
             # If no deployments found, add a "General" placeholder
@@ -166,37 +228,28 @@ def discover_resources_and_deployments(credential, subscription_id, resource_gro
             })
         else:
             for d in depts:
-                # Determine type for carbon math
-                m_name = d['model_name'].lower()
-                if "dall" in m_name:
-                    m_type = "image"
-                elif "o1" in m_name or "reasoning" in m_name:
-                    m_type = "reasoning"
-                elif "embedding" in m_name:
-                    m_type = "embedding"
-                else:
-                    m_type = "text"
-
                 final_inventory.append({
                     **acct,
                     "deployment_name": d['deployment_name'],
                     "model_name": d['model_name'],
-                    "type": m_type
+                    # Determine type for carbon math
+                    "type": classify(d['model_name'])
                 })
-        
-        if found_accounts_list:
-            pbar.progress((i + 1) / len(found_accounts_list))
-            
-    if found_accounts_list:
-        pbar.empty()
                 
     return final_inventory, logs
 
-def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
+@st.cache_resource
+def get_monitor_client(_credential, subscription_id):
+    """One thread-safe MonitorManagementClient per subscription, shared by the metric workers."""
+    from azure.mgmt.monitor import MonitorManagementClient
+    return MonitorManagementClient(_credential, subscription_id)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_detailed_metrics(_credential, subscription_id, inventory_list, days=7):
     """
     Fetches usage metrics filtered by Deployment Name to get per-model granularity.
     """
-    client = MonitorManagementClient(credential, subscription_id)
+    client = get_monitor_client(_credential, subscription_id)
     
     # Metrics: 'GeneratedImages' (DALL-E), 'ProcessedPromptTokens'/'GeneratedTokens' (Text)
     metric_names = "ProcessedPromptTokens,GeneratedTokens,GeneratedImages"
@@ -215,56 +268,91 @@ def fetch_detailed_metrics(credential, subscription_id, inventory_list, days=7):
             grouped_inventory[item['id']] = []
         grouped_inventory[item['id']].append(item)
 
-    progress_bar = st.progress(0)
-    total_steps = len(grouped_inventory)
-    current_step = 0
-
-    for account_id, deployments in grouped_inventory.items():
-        try:
-            for dept in deployments:
-                dept_name = dept['deployment_name']
-                is_agg = dept_name == "All Models (Aggregated)"
-                
-                # Filter syntax for Azure Monitor
-                odata_filter = f"ModelDeploymentName eq '{dept_name}'" if not is_agg else None
-                
-                metrics_data = client.metrics.list(
-                    resource_uri=account_id,
-                    timespan=timespan,
-                    interval="PT1H",
-                    metricnames=metric_names,
-                    aggregation="Total",
-                    filter=odata_filter 
-                )
-                
-                for item in metrics_data.value:
-                    metric_name = item.name.value
-                    for timeseries in item.timeseries:
-                        for data in timeseries.data:
-                            if data.total and data.total > 0:
-                                data_rows.append({
-                                    "TimeStamp": data.time_stamp,
-                                    "Account": dept['name'],
-                                    "Deployment": dept_name,
-                                    "Model": dept['model_name'],
-                                    "Type": dept['type'],
-                                    "Metric": metric_name,
-                                    "Value": data.total
-                                })
-
-        except Exception as e:
-            if "BadRequest" not in str(e): 
-                errors.append(f"Error {account_id.split('/')[-1]}: {str(e)}")
+    def fetch_account(account_id, deployments):
+        # One call per account: OR the deployment names together and split the series client-side
+        named = {d['deployment_name'].lower(): d for d in deployments if d['deployment_name'] != "All Models (Aggregated)"}
+        odata_filter = " or ".join(f"ModelDeploymentName eq '{d['deployment_name']}'" for d in named.values()) or None
         
-        current_step += 1
-        progress_bar.progress(current_step / total_steps)
+        query = dict(
+            resource_uri=account_id,
+            timespan=timespan,
+            interval="PT1H",
+            metricnames=metric_names,
+            aggregation="Total"
+        )
+        if odata_filter:
+            # Filtered queries return only 10 series by default; ask for one per deployment
+            query.update(filter=odata_filter, top=max(10, len(named)), orderby="Total desc")
+        metrics_data = client.metrics.list(**query)
         
-    progress_bar.empty()
-    return pd.DataFrame(data_rows), errors
+        # Resolve each series to its (account, deployment) key once, then flatten points into thin tuples
+        series = []
+        dropped = 0
+        for item in metrics_data.value:
+            metric_name = item.name.value
+            for timeseries in item.timeseries:
+                # Re-attribute each series to its deployment via the split dimension
+                dept = None
+                for md in (timeseries.metadatavalues or []):
+                    if md.name.value.lower() == "modeldeploymentname":
+                        dept = named.get(str(md.value).lower())
+                if dept is None:
+                    # Unsplit series can only be attributed when the account has a single entry
+                    if len(deployments) != 1:
+                        dropped += 1
+                        continue
+                    dept = deployments[0]
+                series.append((dept['deployment_name'], metric_name, timeseries.data or []))
+        rows = [
+            (account_id, dept_name, d.time_stamp, metric_name, d.total)
+            for dept_name, metric_name, data in series for d in data if d.total and d.total > 0
+        ]
+        return rows, dropped
+
+    # Accounts are independent: fan out (capped for Monitor read limits), tick progress as each lands
+    rows_by_account = {}
+    if grouped_inventory:
+        progress_bar = st.progress(0)
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            futures = {ex.submit(fetch_account, account_id, deps): account_id for account_id, deps in grouped_inventory.items()}
+            for i, fut in enumerate(as_completed(futures)):
+                account_id = futures[fut]
+                try:
+                    rows_by_account[account_id], dropped = fut.result()
+                    if dropped:
+                        errors.append(f"Error {account_id.split('/')[-1]}: {dropped} series had no matching deployment and were skipped")
+                except Exception as e:
+                    if "BadRequest" not in str(e): 
+                        errors.append(f"Error {account_id.split('/')[-1]}: {str(e)}")
+                if (i + 1) % progress_every(len(futures)) == 0 or i + 1 == len(futures):
+                    progress_bar.progress((i + 1) / len(futures))
+        progress_bar.empty()
+
+    # Merge in inventory order so the frame doesn't depend on completion order
+    for account_id in grouped_inventory:
+        data_rows.extend(rows_by_account.get(account_id, []))
+
+    # Deployment metadata is attached once per frame instead of being copied into every point
+    inv_df = pd.DataFrame(inventory_list, columns=['id', 'name', 'deployment_name', 'model_name', 'type']).rename(columns={
+        'id': 'AccountId', 'name': 'Account', 'deployment_name': 'Deployment', 'model_name': 'Model', 'type': 'Type'
+    }).drop_duplicates(['AccountId', 'Deployment'])
+    df = pd.DataFrame(data_rows, columns=['AccountId', 'Deployment', 'TimeStamp', 'Metric', 'Value'])
+    df = df.merge(inv_df, on=['AccountId', 'Deployment'], how='left')
+    # Compact dtypes before the frame is pickled into the cache: dictionary-encoded labels
+    # (Arrow dictionary arrays for st.dataframe) and a real datetime column for TimeStamp
+    df = df[["TimeStamp", "Account", "Deployment", "Model", "Type", "Metric", "Value"]].astype({
+        c: 'category' for c in ("Account", "Deployment", "Model", "Type", "Metric")
+    })
+    df["TimeStamp"] = pd.to_datetime(df["TimeStamp"])
+    return df, errors
 
+@st.cache_data(ttl=3600)
 def generate_demo_data_detailed(days=7):
+    rng = np.random.default_rng()
     dates = pd.date_range(end=datetime.now(), periods=days*24, freq='H')
-    data = []
+    n = len(dates)
+    busy = (dates.hour >= 9) & (dates.hour <= 17)
+    hour_mod = np.where(busy, 10, 1)
     
     models = [
         {"name": "gpt-4", "type": "text", "dept": "gpt-4-deployment"},
@@ -273,22 +361,27 @@ def generate_demo_data_detailed(days=7):
         {"name": "dall-e-3", "type": "image", "dept": "img-gen"}
     ]
     
-    for date in dates:
-        hour_mod = 10 if 9 <= date.hour <= 17 else 1
-        
-        for m in models:
-            if m['type'] == 'image':
-                val = int(random.random() * 5 * hour_mod) if hour_mod > 1 else 0
-                if val > 0:
-                    data.append({"TimeStamp": date, "Model": m['name'], "Type": "image", "Metric": "GeneratedImages", "Value": val, "Deployment": m['dept']})
-            else:
-                prompts = int(random.gauss(500, 100) * hour_mod)
-                gens = int(random.gauss(200, 50) * hour_mod)
-                if prompts > 0:
-                    data.append({"TimeStamp": date, "Model": m['name'], "Type": m['type'], "Metric": "ProcessedPromptTokens", "Value": prompts, "Deployment": m['dept']})
-                    data.append({"TimeStamp": date, "Model": m['name'], "Type": m['type'], "Metric": "GeneratedTokens", "Value": gens, "Deployment": m['dept']})
+    # One batch of draws per model over all hours, built as columnar frames
+    frames = []
+    for m in models:
+        if m['type'] == 'image':
+            imgs = (rng.random(n) * 5 * hour_mod).astype(int) * busy
+            keep = imgs > 0
+            frames.append(pd.DataFrame({"TimeStamp": dates[keep], "Model": m['name'], "Type": "image", "Metric": "GeneratedImages", "Value": imgs[keep], "Deployment": m['dept']}))
+        else:
+            prompts = (rng.normal(500, 100, n) * hour_mod).astype(int)
+            gens = (rng.normal(200, 50, n) * hour_mod).astype(int)
+            keep = prompts > 0
+            frames.append(pd.DataFrame({"TimeStamp": dates[keep], "Model": m['name'], "Type": m['type'], "Metric": "ProcessedPromptTokens", "Value": prompts[keep], "Deployment": m['dept']}))
+            frames.append(pd.DataFrame({"TimeStamp": dates[keep], "Model": m['name'], "Type": m['type'], "Metric": "GeneratedTokens", "Value": gens[keep], "Deployment": m['dept']}))
                     
-    return pd.DataFrame(data)
+    return pd.concat(frames, ignore_index=True)
+
+def _downsample(df, col, cap=500):
+    """Per-Metric series: hourly while every metric stays within `cap` points, otherwise daily sums."""
+    if df.empty or df.groupby('Metric', observed=True).size().max() <= cap:
+        return df
+    return df.set_index('TimeStamp').groupby('Metric', observed=True)[col].resample('D').sum().reset_index()
 
 # --- UI LAYOUT ---
 
@@ -366,19 +459,21 @@ if fetch_btn:
             for e in errors: st.error(e)
 
     if not df_raw.empty:
+        # 0. Repeated labels as categoricals (demo data has no Account column)
+        for c in ['Type', 'Model', 'Metric', 'Deployment', 'Account']:
+            if c in df_raw:
+                df_raw[c] = df_raw[c].astype('category')
+
         # 1. Calculate Energy & Carbon PER ROW
-        def calc_kwh(row):
-            factor = CARBON_FACTORS.get("standard_text", 0.0004)
-            if row['Type'] == 'image':
-                return row['Value'] * CARBON_FACTORS['image_gen']
-            elif row['Type'] == 'reasoning':
-                factor = CARBON_FACTORS['reasoning_text']
-            elif row['Type'] == 'embedding':
-                factor = CARBON_FACTORS['embedding']
-            return (row['Value'] / 1000) * factor
-
-        df_raw['kWh'] = df_raw.apply(calc_kwh, axis=1)
-        df_raw['Carbon_g'] = df_raw['kWh'] * grid_intensity
+        # kWh per unit of Value: images are per unit, token factors are pre-divided per 1k tokens
+        factor = df_raw['Type'].map({
+            'image': CARBON_FACTORS['image_gen'],
+            'reasoning': CARBON_FACTORS['reasoning_text'] / 1000,
+            'embedding': CARBON_FACTORS['embedding'] / 1000,
+            'text': CARBON_FACTORS['standard_text'] / 1000
+        }).astype(float).fillna(CARBON_FACTORS['standard_text'] / 1000).to_numpy()
+        df_raw['kWh'] = df_raw['Value'].to_numpy(dtype=float) * factor
+        df_raw['Carbon_g'] = df_raw['kWh'].to_numpy() * grid_intensity
         
         total_co2 = df_raw['Carbon_g'].sum()
         total_kwh = df_raw['kWh'].sum()
@@ -403,20 +498,22 @@ if fetch_btn:
             st.subheader("Which model is the heaviest emitter?")
             
             # Group by Model and sum Carbon
-            df_model = df_raw.groupby("Model")[["Carbon_g", "Value"]].sum().reset_index()
+            df_model = df_raw.groupby("Model", observed=True)[["Carbon_g", "Value"]].sum().reset_index()
             df_model = df_model.sort_values("Carbon_g", ascending=False)
             
             col_chart, col_details = st.columns([2, 1])
             
             with col_chart:
+                # Only the plotted columns are serialized to the browser
                 fig_bar = px.bar(
-                    df_model, 
+                    df_model[["Model", "Carbon_g"]], 
                     x="Model", 
                     y="Carbon_g", 
                     color="Model", 
                     title="Total Carbon Emissions by Model",
                     text_auto='.1f'
                 )
+                fig_bar.update_traces(hovertemplate='%{y:.2f}')
                 st.plotly_chart(fig_bar, use_container_width=True)
                 
             with col_details:
@@ -425,21 +522,34 @@ if fetch_btn:
 
         with tab_features:
             st.subheader("Usage Type Breakdown")
-            df_img = df_raw[df_raw['Metric'] == 'GeneratedImages']
-            df_text = df_raw[df_raw['Metric'].isin(['ProcessedPromptTokens', 'GeneratedTokens'])]
+            # One pass over Metric, then pick the sub-frames each chart needs
+            by_metric = dict(tuple(df_raw.groupby('Metric', observed=True)))
+            df_img = by_metric.get('GeneratedImages', df_raw.iloc[:0])
+            df_text = pd.concat([by_metric.get(m, df_raw.iloc[:0]) for m in ('ProcessedPromptTokens', 'GeneratedTokens')])
             
             c_a, c_b = st.columns(2)
             with c_a:
                 st.markdown("#### 📝 Text Usage")
                 if not df_text.empty:
-                    fig_text = px.area(df_text, x="TimeStamp", y="Value", color="Metric", title="Token Volume Over Time")
+                    # WebGL line per metric (summed across models) so long windows stay responsive
+                    df_text_hourly = df_text.groupby(['Metric', 'TimeStamp'], observed=True, as_index=False)['Value'].sum()
+                    df_text_ts = _downsample(df_text_hourly, 'Value')
+                    fig_text = go.Figure([
+                        go.Scattergl(x=g['TimeStamp'], y=g['Value'], name=metric, mode='lines', hovertemplate='%{y:,.0f}')
+                        for metric, g in df_text_ts.groupby('Metric', observed=True)
+                    ])
+                    granularity = "Hourly" if df_text_ts is df_text_hourly else "Daily"
+                    fig_text.update_layout(title=f"Token Volume Over Time ({granularity})", xaxis_title="TimeStamp", yaxis_title="Value", legend_title="Metric")
                     st.plotly_chart(fig_text, use_container_width=True)
                 else:
                     st.info("No text usage data.")
             with c_b:
                 st.markdown("#### 🖼️ Image Generation")
                 if not df_img.empty:
-                    fig_img = px.bar(df_img, x="TimeStamp", y="Value", title="Images Generated (Count)")
+                    # Plotly has no WebGL bar trace, so cut the point count by binning to days instead
+                    df_img_daily = df_img.resample('D', on='TimeStamp')['Value'].sum().reset_index()
+                    fig_img = px.bar(df_img_daily, x="TimeStamp", y="Value", title="Images Generated (Count per Day)")
+                    fig_img.update_traces(hovertemplate='%{y:,.0f}')
                     st.plotly_chart(fig_img, use_container_width=True)
                 else:
                     st.info("No image generation data.")
@@ -1,10 +1,9 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 from datetime import datetime, timedelta
-from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
-from azure.mgmt.monitor import MonitorManagementClient
-import random
 
 # Page Configuration
 st.set_page_config(
@@ -37,6 +36,9 @@ def get_azure_credentials():
     Authenticates using DefaultAzureCredential. 
     If that fails (no CLI/Env vars), falls back to InteractiveBrowserCredential.
     """
+    # Azure SDK imports are deferred so Demo mode never loads them
+    from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
+
     try:
         # 1. Try silent authentication (Env vars, Managed Identity, Azure CLI)
         credential = DefaultAzureCredential()
@@ -53,6 +55,25 @@ def get_azure_credentials():
             st.error(f"Authentication failed: {e}. Please ensure you have internet access or try installing Azure CLI and running 'az login'.")
             return None
 
+@st.cache_data(ttl=3600)
+def generate_demo_metrics(days=7):
+    """Hourly demo usage for the last `days`, drawn in one vectorized batch."""
+    rng = np.random.default_rng()
+    dates = pd.date_range(end=datetime.now(), periods=days*24, freq='H')
+    n = len(dates)
+    # Simulate daily working hours spike
+    hour_modifier = np.where((dates.hour >= 9) & (dates.hour <= 17), 10, 1)
+    prompts = np.maximum((rng.normal(1000, 300, n) * hour_modifier).astype(int), 0)
+    completions = np.maximum((rng.normal(500, 150, n) * hour_modifier).astype(int), 0)
+    
+    return pd.DataFrame({
+        "TimeStamp": dates,
+        "Prompt Tokens": prompts,
+        "Completion Tokens": completions,
+        "Total Tokens": prompts + completions,
+        "Latency (ms)": rng.uniform(200, 800, n)
+    })
+
 def fetch_metrics(subscription_id, resource_group, resource_name, days=7, demo_mode=False):
     """
     Fetches real metrics from Azure Monitor or generates demo data.
@@ -61,24 +82,7 @@ def fetch_metrics(subscription_id, resource_group, resource_name, days=7, demo_m
     
     # --- DEMO MODE GENERATOR ---
     if demo_mode:
-        dates = pd.date_range(end=datetime.now(), periods=days*24, freq='H')
-        data = []
-        for date in dates:
-            # Simulate daily working hours spike
-            hour_modifier = 10 if 9 <= date.hour <= 17 else 1
-            prompts = int(random.gauss(1000, 300) * hour_modifier)
-            completions = int(random.gauss(500, 150) * hour_modifier)
-            if prompts < 0: prompts = 0
-            if completions < 0: completions = 0
-            
-            data.append({
-                "TimeStamp": date,
-                "Prompt Tokens": prompts,
-                "Completion Tokens": completions,
-                "Total Tokens": prompts + completions,
-                "Latency (ms)": random.uniform(200, 800)
-            })
-        return pd.DataFrame(data)
+        return generate_demo_metrics(days)
 
     # --- REAL AZURE FETCHING ---
     credential = get_azure_credentials()
@@ -86,6 +90,8 @@ def fetch_metrics(subscription_id, resource_group, resource_name, days=7, demo_m
         st.error("Could not obtain credentials.")
         return pd.DataFrame()
 
+    from azure.mgmt.monitor import MonitorManagementClient
+
     client = MonitorManagementClient(credential, subscription_id)
     resource_id = f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}/providers/Microsoft.CognitiveServices/accounts/{resource_name}"
     
@@ -110,32 +116,36 @@ def fetch_metrics(subscription_id, resource_group, resource_name, days=7, demo_m
         st.info("Check your Subscription ID and Resource details.")
         return pd.DataFrame()
 
-    # Parse Azure response into DataFrame
-    records = {}
+    # Parse Azure response into long (TimeStamp, Metric, Value) rows, then pivot once
+    rows = []
     
     for item in metrics_data.value:
         metric_name = item.name.value
         for timeseries in item.timeseries:
             for data in timeseries.data:
-                ts = data.time_stamp
-                val = data.total if data.total is not None else 0
-                
-                if ts not in records:
-                    records[ts] = {"TimeStamp": ts, "Prompt Tokens": 0, "Completion Tokens": 0}
-                
-                if metric_name == "ProcessedPromptTokens":
-                    records[ts]["Prompt Tokens"] = val
-                elif metric_name == "GeneratedCompletionTokens":
-                    records[ts]["Completion Tokens"] = val
+                rows.append((data.time_stamp, metric_name, data.total if data.total is not None else 0))
 
-    df = pd.DataFrame(list(records.values()))
+    df = pd.DataFrame(rows, columns=["TimeStamp", "Metric", "Value"])
     if not df.empty:
+        df = (
+            df.pivot_table(index="TimeStamp", columns="Metric", values="Value", aggfunc="sum", fill_value=0)
+            .rename(columns={"ProcessedPromptTokens": "Prompt Tokens", "GeneratedCompletionTokens": "Completion Tokens"})
+            .reindex(columns=["Prompt Tokens", "Completion Tokens"], fill_value=0)
+            .reset_index()
+            .rename_axis(columns=None)
+        )
         df["Total Tokens"] = df["Prompt Tokens"] + df["Completion Tokens"]
         df["TimeStamp"] = pd.to_datetime(df["TimeStamp"])
         df = df.sort_values("TimeStamp")
     
     return df
 
+def _downsample(df, cols, cap=500):
+    """Wide hourly frame up to `cap` rows, otherwise daily sums of `cols`."""
+    if len(df) <= cap:
+        return df
+    return df.resample('D', on='TimeStamp')[cols].sum().reset_index()
+
 # --- UI LAYOUT ---
 
 st.title("📊 Azure GenAI Usage Dashboard")
@@ -195,14 +205,16 @@ if fetch_btn:
 
         with tab1:
             st.subheader("Usage Over Time")
-            fig_line = px.area(
-                df, 
-                x="TimeStamp", 
-                y=["Prompt Tokens", "Completion Tokens"],
-                title="Token Consumption (Hourly)",
-                color_discrete_map={"Prompt Tokens": "#0078D4", "Completion Tokens": "#00CC6A"}
-            )
-            fig_line.update_layout(xaxis_title="Time", yaxis_title="Token Count")
+            # Long windows are plotted as daily sums to keep the payload small
+            df_plot = _downsample(df, ["Prompt Tokens", "Completion Tokens"])
+            # WebGL traces (Scattergl can't stack, so each series is its own filled line)
+            fig_line = go.Figure([
+                go.Scattergl(x=df_plot["TimeStamp"], y=df_plot[col], name=col, mode="lines", fill="tozeroy", line=dict(color=color),
+                              hovertemplate="%{y:,.0f}")
+                for col, color in [("Prompt Tokens", "#0078D4"), ("Completion Tokens", "#00CC6A")]
+            ])
+            granularity = "Hourly" if df_plot is df else "Daily"
+            fig_line.update_layout(title=f"Token Consumption ({granularity})", xaxis_title="Time", yaxis_title="Token Count")
             st.plotly_chart(fig_line, use_container_width=True)
 
         with tab2:
@@ -0,0 +1,38 @@
+import importlib.util
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace as NS
+
+import pytest
+
+ACCOUNT_ID = "/subscriptions/sub/resourceGroups/rg/providers/Microsoft.CognitiveServices/accounts/acct"
+
+
+@pytest.fixture(scope="module")
+def costreport():
+    # The app renders its demo page on import (bare mode); only the fetch helpers are used here
+    spec = importlib.util.spec_from_file_location("costreport", Path(__file__).parents[1] / "costreport.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _series(deployment, total):
+    return NS(
+        metadatavalues=[NS(name=NS(value="ModelDeploymentName"), value=deployment)],
+        data=[NS(time_stamp=datetime(2024, 1, 1), total=total)],
+    )
+
+
+def test_split_series_outside_inventory_is_dropped(costreport, monkeypatch):
+    # Only live-dep is in the inventory; deleted-dep still has traffic in the window
+    metric = NS(name=NS(value="ProcessedPromptTokens"), timeseries=[_series("live-dep", 100), _series("deleted-dep", 5000)])
+    client = NS(metrics=NS(list=lambda **query: NS(value=[metric])))
+    monkeypatch.setattr(costreport, "get_monitor_client", lambda _credential, subscription_id: client)
+    costreport.fetch_detailed_metrics.clear()
+
+    inventory = [{"id": ACCOUNT_ID, "name": "acct", "group": "rg", "deployment_name": "live-dep", "model_name": "gpt-4", "type": "text"}]
+    df, errors = costreport.fetch_detailed_metrics(None, "sub", inventory, days=1)
+
+    assert df.groupby("Deployment", observed=True)["Value"].sum().to_dict() == {"live-dep": 100}
+    assert errors == ["Error acct: 1 series had no matching deployment and were skipped"]